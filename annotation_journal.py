@@ -0,0 +1,203 @@
+import os
+import copy
+import json
+import threading
+
+from datetime import datetime
+
+from utils import update_master
+
+
+class AnnotationJournal:
+    '''
+        annotation commit/revert 를 master json 옆 jsonl 파일에 append하는 write-ahead journal
+
+        한 줄 = record 하나의 annotation 상태 전체 (key, op, label, 상태, timestamp)
+        상태 기반이므로 replay는 순서대로 덮어쓰기만 하면 되고 몇 번 반복해도 결과가 같다.
+
+        rotate()는 현재 journal을 '<journal>.<n>' segment로 봉인하고 새 journal에 이어 쓴다.
+        봉인된 segment는 그 내용이 master json에 저장된 뒤 remove_segments()로 지운다.
+    '''
+    STATE_KEYS = ('annotation_info', 'is_annotated', 'annotation_time')
+
+    def __init__(self, json_path, journal_path=None):
+        self.json_path = json_path
+        self.journal_path = journal_path
+        if self.journal_path is None:
+            self.journal_path = json_path + '.journal'
+
+        self._f = None
+        self.replayed_keys = set()
+
+    def _open(self):
+        if self._f is None:
+            self._f = open(self.journal_path, 'a', encoding='utf-8')
+        return self._f
+
+    def append(self, key, record, op, label=None):
+        entry = {
+            'key' : key,
+            'op' : op,          # 'commit' or 'revert'
+            'label' : label,
+            'time' : str(datetime.now()),
+        }
+        for state_key in self.STATE_KEYS:
+            entry[state_key] = record.get(state_key)
+
+        f = self._open()
+        f.write(json.dumps(entry, ensure_ascii = False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+    @classmethod
+    def snapshot(cls, record):
+        '''
+            record의 annotation 상태만 복사 (다른 thread로 넘겨도 GUI의 변경과 섞이지 않음)
+        '''
+        return {state_key : copy.deepcopy(record.get(state_key)) for state_key in cls.STATE_KEYS}
+
+    def get_segments(self):
+        '''
+            봉인된 segment 경로 목록 (오래된 순)
+        '''
+        dir_name = os.path.dirname(self.journal_path) or '.'
+        prefix = os.path.basename(self.journal_path) + '.'
+        segments = []
+        for file_name in os.listdir(dir_name):
+            if file_name.startswith(prefix) and file_name[len(prefix):].isdigit():
+                segments.append((int(file_name[len(prefix):]), os.path.join(dir_name, file_name)))
+        return [path for _, path in sorted(segments)]
+
+    def rotate(self):
+        '''
+            현재 journal을 봉인하고 봉인된 segment 전체 목록을 리턴 (다음 append는 새 journal에)
+        '''
+        self.close()
+        segments = self.get_segments()
+        if os.path.isfile(self.journal_path):
+            seq = 0
+            if len(segments) > 0:
+                seq = int(segments[-1].rsplit('.', 1)[1]) + 1
+            segment = '{}.{}'.format(self.journal_path, seq)
+            os.replace(self.journal_path, segment)
+            segments.append(segment)
+        return segments
+
+    def remove_segments(self, segments):
+        for segment in segments:
+            if os.path.isfile(segment):
+                os.remove(segment)
+
+    def replay(self, patient_dict):
+        '''
+            봉인된 segment -> 현재 journal 순서로 patient_dict에 적용하고 적용한 entry 수를 리턴
+        '''
+        cnt = 0
+        for journal_path in self.get_segments() + [self.journal_path]:
+            if not os.path.isfile(journal_path):
+                continue
+
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError: # crash 도중 잘린 마지막 줄
+                        continue
+                    if entry['key'] not in patient_dict:
+                        continue
+
+                    record = patient_dict[entry['key']]
+                    for state_key in self.STATE_KEYS:
+                        record[state_key] = entry[state_key]
+                    self.replayed_keys.add(entry['key'])
+                    cnt += 1
+
+        return cnt
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class AutosaveWriter:
+    '''
+        master json 저장을 background thread에서 하는 기능
+
+        GUI thread는 바뀐 record의 annotation 상태만 submit() 으로 넘기고 바로 돌아간다.
+        - 저장 중에 들어온 요청은 하나로 합쳐서 (나중 상태 우선) 다음 번에 한 번만 쓴다.
+        - master lock을 잡고 디스크의 master를 lazy로 열어 바뀐 record만 다시 저장 (json : tmp 파일 -> rename, sqlite : row update)
+        - 저장이 끝나면 같이 넘겨받은 journal segment를 지운다.
+          실패하면 변경 내용을 다시 대기열에 넣고 (segment는 남겨둠) retry_interval 뒤에 다시 시도
+    '''
+    def __init__(self, json_path, journal, retry_interval=5.0):
+        self.json_path = json_path
+        self.journal = journal
+        self.retry_interval = retry_interval
+
+        self._pending = {}   # key -> annotation 상태
+        self._segments = []  # 저장이 끝나면 지울 journal segment
+        self._busy = False
+        self._stop = False
+        self._num_errors = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, changes, segments=None):
+        with self._cond:
+            self._pending.update(changes)
+            self._segments += segments or []
+            self._cond.notify_all()
+
+    def _write(self, changes):
+        update_master(self.json_path, changes) # 다른 writer (다른 ECG_GUI, report)와 master lock 공유
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._pending) == 0 and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                changes, segments = self._pending, self._segments
+                self._pending, self._segments = {}, []
+                self._busy = True
+
+            try:
+                self._write(changes)
+            except Exception as e:
+                print('autosave failed : {!r}'.format(e))
+                with self._cond:
+                    changes.update(self._pending) # 그 사이 들어온 상태가 우선
+                    self._pending = changes
+                    self._segments = segments + self._segments
+                    self._busy = False
+                    self._num_errors += 1
+                    self._cond.notify_all()
+                    self._cond.wait(self.retry_interval) # submit / flush 가 오면 바로 다시 시도
+                continue
+
+            self.journal.remove_segments(segments)
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def flush(self):
+        '''
+            대기 중인 저장이 끝날 때까지 기다린다. 저장에 실패하면 False
+        '''
+        with self._cond:
+            num_errors = self._num_errors
+            self._cond.notify_all()
+            while (len(self._pending) > 0 or self._busy) and self._num_errors == num_errors:
+                self._cond.wait()
+            return len(self._pending) == 0 and not self._busy
+
+    def close(self):
+        saved = self.flush()
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+        return saved
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import cv2
+import numpy as np
+from reportlab.pdfgen.canvas import Canvas
+
+from datetime import datetime
+
+from utils import parse_json, write_json
+from render import RenderFigure, ECG_DRAWERS, ECGDrawer
+from diagnosis import ECG_GUI
+
+
+def make_synthetic_ecg(num_samples, rng, fs=100.0):
+    '''
+        QRS 비슷한 spike + baseline wander + noise 로 된 가짜 ecg wave
+    '''
+    t = np.arange(num_samples) / fs
+    heart_rate = rng.uniform(0.8, 1.6) # Hz
+    phase = (t * heart_rate) % 1.0
+    qrs = np.exp(-((phase - 0.5) ** 2) / 0.0005)
+    wander = 0.2 * np.sin(2 * np.pi * 0.3 * t + rng.uniform(0, 2*np.pi))
+    noise = 0.05 * rng.standard_normal(num_samples)
+    raw = qrs + wander + noise
+    denoised = qrs + 0.1 * wander
+    return raw, denoised
+
+def make_synthetic_master(json_path, num_patients, records_per_patient, num_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    data = {}
+    for p in range(num_patients):
+        p_id = 'B-{:06d}'.format(p)
+        for r in range(records_per_patient):
+            raw, denoised = make_synthetic_ecg(num_samples, rng)
+            key = '{}_ecg_2021-06-16_{:02d}.csv'.format(p_id, r)
+            data[key] = {
+                'LR' : [round(float(v), 3) for v in rng.uniform(0, 1, 6)],
+                'raw_ecg_wave_voltage' : raw.round(5).tolist(),
+                'denoised_ecg_wave_voltage' : denoised.round(5).tolist(),
+                'is_printed' : False,
+                'is_annotated' : True,
+                'annotation_info' : ['NSR', 'PAC', 'artifact'],
+                'annotation_time' : None,
+                'recorded_time' : '2021-06-16 {:02d}:00'.format(r),
+                'patient_id' : p_id,
+            }
+    write_json(json_path, data)
+    return data
+
+def make_resources(work_dir):
+    '''
+        report 생성에 필요한 가짜 리소스 (logo, board, cover, button, technician csv)
+    '''
+    resource = {}
+    resource['logo'] = os.path.join(work_dir, 'logo.png')
+    resource['board'] = os.path.join(work_dir, 'board.png')
+    resource['button'] = os.path.join(work_dir, 'button.png')
+    resource['cover'] = os.path.join(work_dir, 'cover.pdf')
+    cv2.imwrite(resource['logo'], np.full((20, 100, 3), 200, dtype=np.uint8))
+    cv2.imwrite(resource['board'], np.full((690, 120, 3), 220, dtype=np.uint8))
+    cv2.imwrite(resource['button'], np.full((300, 800, 3), 255, dtype=np.uint8))
+
+    cover = Canvas(resource['cover'])
+    cover.drawString(100, 100, 'benchmark cover')
+    cover.showPage()
+    cover.save()
+    return resource
+
+def summarize(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        'n' : int(samples.size),
+        'total' : float(samples.sum()),
+        'mean' : float(samples.mean()),
+        'p50' : float(np.percentile(samples, 50)),
+        'p90' : float(np.percentile(samples, 90)),
+        'p99' : float(np.percentile(samples, 99)),
+        'max' : float(samples.max()),
+    }
+
+def timeit(fn, repeat=1):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+class Benchmark:
+    def __init__(self, **kwargs):
+        self.work_dir = kwargs.get('work_dir')
+        self.num_patients = kwargs.get('num_patients')
+        self.records_per_patient = kwargs.get('records_per_patient')
+        self.num_samples = kwargs.get('num_samples')
+        self.repeat = kwargs.get('repeat')
+        self.num_workers = kwargs.get('num_workers')
+        self.skip = kwargs.get('skip') or []
+
+        self.json_path = os.path.join(self.work_dir, 'bench_master.json')
+        self.render_dir = os.path.join(self.work_dir, 'render')
+        self.results = {}
+
+    def _record(self, name, samples):
+        self.results[name] = summarize(samples)
+        print('{:<40} mean {:9.4f}s  p90 {:9.4f}s  (n={})'.format(
+            name, self.results[name]['mean'], self.results[name]['p90'], self.results[name]['n']))
+
+    def bench_parse_json(self):
+        self._record('parse_json', timeit(lambda: parse_json(self.json_path), self.repeat))
+
+        def parse_lazy():
+            data, _ = parse_json(self.json_path, lazy=True)
+            data[next(iter(data))]
+        self._record('parse_json.lazy_one_record', timeit(parse_lazy, self.repeat))
+
+    def bench_render(self):
+        data, _ = parse_json(self.json_path)
+        rng = np.random.default_rng(0)
+        keys = list(data.keys())
+
+        # strip 하나 (10s chunk) 당 drawer 비용
+        chunks = []
+        for key in rng.choice(keys, size=min(len(keys), 20), replace=False):
+            raw = np.asarray(data[key]['raw_ecg_wave_voltage'])
+            chunks.append(raw[: len(raw) // 3])
+
+        drawers = {name: cls() for name, cls in ECG_DRAWERS.items()}
+        drawers['matplotlib.reuse_figure'] = ECGDrawer(reuse_figure=True)
+        for name, drawer in drawers.items():
+            samples = []
+            for chunk in chunks:
+                samples += timeit(lambda: drawer(None, chunk, 'Original 1/3', 1.0, '#e35f62'))
+            self._record('render.strip.{}'.format(name), samples)
+
+        # RenderFigure 전체 (cache 무시)
+        for drawer in ECG_DRAWERS:
+            for num_workers in sorted({1, self.num_workers}):
+                app = RenderFigure(
+                    json = self.json_path,
+                    render_dir = self.render_dir,
+                    force_render = True,
+                    fig_line_width = 1.0,
+                    line_color = '#e35f62',
+                    drawer = drawer,
+                    num_workers = num_workers,
+                )
+                self._record('render.end_to_end.{}.workers{}'.format(drawer, num_workers), timeit(app))
+
+        # 변경 없는 두 번째 실행 (render cache hit)
+        app = RenderFigure(json = self.json_path, render_dir = self.render_dir, fig_line_width = 1.0,
+                           line_color = '#e35f62', drawer = 'raster')
+        self._record('render.end_to_end.cached', timeit(app))
+
+    def bench_gui(self, resource):
+        app = ECG_GUI(
+            master_json = self.json_path,
+            render_dir = self.render_dir,
+            button_path = resource['button'],
+            figsize = (10,1.5),
+            fig_line_width = 1.0,
+            line_color = '#e35f62',
+            buttonsize = (800, 300),
+            drawer = 'raster',
+            prefetch = 0, # prefetch cache hit이 섞이지 않도록 매 frame 디스크에서 읽는다
+        )
+        try:
+            samples = []
+            for idx in app.patient_idx_list:
+                for time_step in range(1, 4):
+                    samples += timeit(lambda: app.read_ecg_image(idx, time_step, global_step='1 / 1'))
+            self._record('gui.read_ecg_image', samples)
+        finally:
+            if app.prefetcher is not None:
+                app.prefetcher.close()
+            if app.autosave is not None:
+                app.autosave.close()
+            app.journal.close()
+
+    def bench_report(self, resource):
+        try:
+            from report import ECGReport, PDF
+        except Exception as e: # font 파일 (NanumGothicLight.ttf)이 없는 경우 등
+            print('report benchmark skipped : {!r}'.format(e))
+            self.results['report.skipped'] = repr(e)
+            return
+
+        technician_csv = os.path.join(self.work_dir, 'technician.csv')
+        data, _ = parse_json(self.json_path)
+        p_ids = sorted({v['patient_id'] for v in data.values()})
+        with open(technician_csv, 'w') as f:
+            f.write('id,name\n')
+            for p_id in p_ids:
+                f.write('{},bench\n'.format(p_id))
+
+        app = ECGReport(
+            master_json = self.json_path,
+            technician_csv = technician_csv,
+            pdf_method = PDF,
+            pdf_root = os.path.join(self.work_dir, 'pdf'),
+            render_dir = self.render_dir,
+            meta = dict(
+                cover = resource['cover'],
+                cover_page = 1,
+                title = 'benchmark',
+                logo = resource['logo'],
+                board = resource['board'],
+                legend_board = 'benchmark',
+            )
+        )
+
+        per_report, per_page = [], []
+        num_pages = int(self.records_per_patient / 2 + 0.5)
+        for p_id in p_ids:
+            elapsed = timeit(lambda: app.run(p_id))[0]
+            per_report.append(elapsed)
+            per_page.append(elapsed / max(num_pages, 1))
+        self._record('report.run', per_report)
+        self._record('report.run.per_page', per_page)
+
+    def __call__(self):
+        os.makedirs(self.work_dir, exist_ok=True)
+        self._record('setup.make_synthetic_master', timeit(lambda: make_synthetic_master(
+            self.json_path, self.num_patients, self.records_per_patient, self.num_samples)))
+        resource = make_resources(self.work_dir)
+
+        if 'parse' not in self.skip:
+            self.bench_parse_json()
+        if 'render' not in self.skip:
+            self.bench_render()
+        if 'gui' not in self.skip:
+            self.bench_gui(resource)
+        if 'report' not in self.skip:
+            self.bench_report(resource)
+
+        return self.results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_patients', type=int, default=50)         # 가짜 환자 수
+    parser.add_argument('--records_per_patient', type=int, default=4)   # 환자 당 record 수
+    parser.add_argument('--num_samples', type=int, default=9000)        # record 당 샘플 수 (30s)
+    parser.add_argument('--repeat', type=int, default=3)                # parse_json 반복 횟수
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count() or 1) # 병렬 렌더링 process 수
+    parser.add_argument('--skip', type=str, nargs='*', default=[], choices=['parse', 'render', 'gui', 'report'])
+    parser.add_argument('--work_dir', type=str, default=None)           # 가짜 데이터 경로 (default: 임시 디렉토리)
+    parser.add_argument('--output', type=str, default='./bench_output.json') # 결과 json
+    return parser.parse_args()
+
+def main():
+    args = opt()
+
+    config = dict(
+        num_patients = args.num_patients,
+        records_per_patient = args.records_per_patient,
+        num_samples = args.num_samples,
+        repeat = args.repeat,
+        num_workers = args.num_workers,
+        skip = args.skip,
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = Benchmark(work_dir = args.work_dir or tmp_dir, **config)()
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'created' : str(datetime.now()),
+            'git_commit' : _git_commit(),
+            'config' : config,
+            'results' : results,
+        }, f, indent='\t', ensure_ascii = False)
+    print('-> {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,91 @@
 import os
 import argparse
-import json
+import threading
 
 import cv2
 import numpy as np
 
 from datetime import datetime
 
-from render import RenderFigure
+import instrument
+from render import RenderFigure, ECGRasterDrawer
 from utils import parse_json, DiagnosisKeyMapper
+from sqlite_store import SQLiteMasterStore
+from waveform_store import WaveformStore
+from annotation_journal import AnnotationJournal, AutosaveWriter
+from work_queue import WorkQueue
+from frame_cache import FrameCache, FramePrefetcher
+from quality import QUALITY_KEY, suggest_artifact, get_quality_score
 
 
 
 class ECG_GUI:
     def __init__(self, **kwargs):
-        self._build_render(**kwargs) # rendering
+        # True이면 사전 렌더링 없이 보여줄 때 waveform에서 바로 그린다
+        self.render_on_demand = kwargs.get('render_on_demand', False)
+
+        if not self.render_on_demand:
+            self._build_render(**kwargs) # rendering
         self._build_params(**kwargs) 
         self._build_common(**kwargs)
 
         self.json_path = kwargs.get('master_json')
         self.patient_dict, self.patient_idx_list = parse_json(self.json_path)
+        if self.render_on_demand:
+            self._build_on_demand_render(**kwargs)
+
+        # 여러 명이 같은 master를 나눠서 작업하는 경우 (work_queue.py)
+        self.work_queue = None
+        if kwargs.get('work_queue') is not None:
+            self.work_queue = WorkQueue(
+                kwargs.get('work_queue'),
+                annotator = kwargs.get('annotator'),
+                lease_seconds = kwargs.get('lease_seconds') or 600
+            )
+
+        # 마지막 autosave 이후의 annotation 복구
+        journal_path = None
+        if self.work_queue is not None: # annotator 별 journal
+            journal_path = '{}.{}.journal'.format(self.work_queue.queue_path, self.work_queue.annotator)
+        self.journal = AnnotationJournal(self.json_path, journal_path)
+        num_replayed = self.journal.replay(self.patient_dict)
+        if num_replayed > 0:
+            print('{} annotations restored from {}'.format(num_replayed, self.journal.journal_path))
+
+        # master json 저장은 background thread가 담당, 마지막 저장 이후 바뀐 record key
+        # (work queue 모드에서는 master에 쓰지 않고 완료된 record를 대기열에 commit)
+        self.autosave = None
+        if self.work_queue is None:
+            self.autosave = AutosaveWriter(self.json_path, self.journal)
+        self.changed_keys = set(self.journal.replayed_keys)
         
+        # quality.py 결과가 있으면 깨끗한 record부터 보여준다 (같은 점수끼리는 기존 순서)
+        self.order_by_quality = kwargs.get('order_by_quality', True)
+        patient_keys = list(self.patient_dict.keys())
+        if self.order_by_quality:
+            if isinstance(self.patient_dict, SQLiteMasterStore): # record를 읽지 않고 quality field만 query
+                qualities = self.patient_dict.field_values(QUALITY_KEY)
+                get_score = lambda patient_id: get_quality_score({QUALITY_KEY : qualities.get(patient_id)})
+            else:
+                get_score = lambda patient_id: get_quality_score(self.patient_dict[patient_id])
+            patient_keys.sort(key=get_score)
+
         self.idx_to_id = {}
-        for patient_id, idx in zip(self.patient_dict.keys(), self.patient_idx_list):
+        self.id_to_idx = {}
+        for patient_id, idx in zip(patient_keys, self.patient_idx_list):
             self.idx_to_id[idx] = patient_id
+            self.id_to_idx[patient_id] = idx
+
+        if self.work_queue is not None:
+            self.work_queue.sync(self.patient_dict, patient_keys)
+        if len(self.changed_keys) > 0:
+            self._save()
+            if self.autosave is not None:
+                self.autosave.flush() # 저장된 상태 기준으로 진행 상황을 세기 위해
 
         self._set_sample_length(**kwargs) # 작업해야 하는 샘플 개수를 결정
+        self._build_prefetch(**kwargs)
+        self._build_zoom(**kwargs)
 
 
     def _build_common(self, **kwargs):
@@ -37,23 +97,86 @@ class ECG_GUI:
 
     def _set_sample_length(self, **kwargs):
         # set exam case length
-        cnt = 0
-        for p_id in self.patient_dict:
-            if self.patient_dict[p_id]['is_annotated']:
-                cnt += 1
+        if isinstance(self.patient_dict, SQLiteMasterStore): # index query
+            cnt = self.patient_dict.count(is_annotated=True)
+        else:
+            cnt = 0
+            for p_id in self.patient_dict:
+                if self.patient_dict[p_id]['is_annotated']:
+                    cnt += 1
 
         self.length = len(self.patient_dict.keys()) - cnt
         self.num_already_done = cnt     
 
-    def _build_render(self, **kwargs):
-        self.render_dir = kwargs.get('render_dir')
-        RenderFigure(
+    def _build_prefetch(self, **kwargs):
+        # 다음에 보여줄 frame 몇 개를 background thread에서 미리 읽어둔다 (0이면 사용 안 함)
+        self.num_prefetch = kwargs.get('prefetch')
+        if self.num_prefetch is None:
+            self.num_prefetch = 6
+
+        cache_size = kwargs.get('frame_cache_size')
+        if cache_size is None:
+            cache_size = 32
+
+        # render_on_demand 모드에서는 frame 개수 대신 byte 한도로 cache 크기를 정한다
+        cache_bytes = kwargs.get('frame_cache_bytes')
+        if cache_bytes is None:
+            cache_bytes = 256 * 1024 * 1024
+        if self.render_on_demand:
+            cache_size = None
+        else:
+            cache_bytes = None
+
+        self.prefetcher = None
+        if self.num_prefetch > 0 or self.render_on_demand:
+            self.prefetcher = FramePrefetcher(
+                loader = lambda key: self._load_frame(*key),
+                cache = FrameCache(max_items = cache_size, max_bytes = cache_bytes),
+                low_priority = self.render_on_demand
+            )
+
+    def _build_zoom(self, **kwargs):
+        # 확대 화면은 렌더링 이미지 대신 waveform store의 min/max pyramid에서 바로 그린다
+        self.max_zoom = kwargs.get('max_zoom')
+        if self.max_zoom is None:
+            self.max_zoom = 64
+
+        wave_dir = kwargs.get('wave_dir')
+        if wave_dir is None:
+            wave_dir = WaveformStore.default_dir(self.json_path)
+        self.wave_store = WaveformStore(wave_dir)
+
+        figsize = kwargs.get('figsize')
+        if figsize is None:
+            figsize = (10,1.5)
+        self.zoom_drawer = ECGRasterDrawer(figsize=figsize)
+        self.zoom_line_width = kwargs.get('fig_line_width')
+        self.zoom_line_color = kwargs.get('line_color')
+        self.reset_view()
+
+    def _get_render_kwargs(self, **kwargs):
+        return dict(
             json = kwargs.get('master_json'),
             render_dir = kwargs.get('render_dir'),
+            wave_dir = kwargs.get('wave_dir'),
+            num_workers = kwargs.get('render_workers'),
+            drawer = kwargs.get('drawer'),
+            figsize = kwargs.get('figsize'),
+            reuse_figure = kwargs.get('reuse_figure'),
             force_render = kwargs.get('force_render'),
             fig_line_width = kwargs.get('fig_line_width'),
             line_color = kwargs.get('line_color')
-        )()
+        )
+
+    def _build_render(self, **kwargs):
+        self.render_dir = kwargs.get('render_dir')
+        RenderFigure(**self._get_render_kwargs(**kwargs))()
+
+    def _build_on_demand_render(self, **kwargs):
+        self.render_dir = kwargs.get('render_dir')
+        self.renderer = RenderFigure(patient_dict=self.patient_dict, **self._get_render_kwargs(**kwargs))
+        # matplotlib / figure 재사용 drawer는 thread-safe 하지 않으므로 GUI thread와 prefetch thread가 번갈아 사용
+        self.render_lock = threading.Lock()
 
     def _build_params(self, **kwargs):
         self.button_img = cv2.imread(  kwargs.get('button_path')  )
@@ -63,9 +186,11 @@ class ECG_GUI:
 
         self.ecg_window_name = 'ECG'
         self.button_window_name = 'DashBoard' # window name
+        self._key_span = instrument.span('gui.key_to_imshow') # key 입력 시점부터 시작
 
         
         self.key_dict = DiagnosisKeyMapper.key_dict
+        self.view_key_dict = DiagnosisKeyMapper.view_key_dict
 
         self.curr_patient_index = 0
 
@@ -77,18 +202,50 @@ class ECG_GUI:
         if len(self.patient_dict[patient_id]['annotation_info']) == 3:
             self.patient_dict[patient_id]['is_annotated'] = True
             self.patient_dict[patient_id]['annotation_time'] = str(datetime.now())
+        self.journal.append(patient_id, self.patient_dict[patient_id], 'commit', label=diagnosis)
+        self.changed_keys.add(patient_id)
+        if self.work_queue is not None:
+            self.work_queue.renew(patient_id)
+
+        if self.patient_dict[patient_id]['is_annotated']:
             self.write()
 
-    def write(self, force_save=False):
-        if force_save:
-            with open(self.json_path, 'w') as f:
-                json.dump(self.patient_dict, f, indent='\t', ensure_ascii = False)
-            self._reset_global_iter_cnt()
-            return 
+    def _save(self):
+        '''
+            바뀐 record의 annotation 상태만 복사해서 background writer에 넘긴다. (journal은 여기서 봉인)
+        '''
+        if self.work_queue is not None:
+            self._commit_to_queue()
+            return
+        if len(self.changed_keys) == 0:
+            return
+        changes = {
+            patient_id : AnnotationJournal.snapshot(self.patient_dict[patient_id]) for patient_id in self.changed_keys
+        }
+        self.changed_keys.clear()
+        self.autosave.submit(changes, self.journal.rotate())
+
+    def _commit_to_queue(self):
+        '''
+            완료된 record를 대기열에 commit (master는 work_queue.py --export 로 갱신)
+            작업 중인 record가 남아 있으면 journal은 봉인하지 않는다.
+        '''
+        for patient_id in [k for k in self.changed_keys if self.patient_dict[k]['is_annotated']]:
+            state = AnnotationJournal.snapshot(self.patient_dict[patient_id])
+            if not self.work_queue.commit(patient_id, state):
+                print('{} was taken by another annotator, labels discarded'.format(patient_id))
+            self.changed_keys.discard(patient_id)
+
+        if len(self.changed_keys) == 0:
+            self.journal.remove_segments(self.journal.rotate())
 
-        if (self.global_iter_cnt+1) % self.save_every == 0:
-            with open(self.json_path, 'w') as f:
-                json.dump(self.patient_dict, f, indent='\t', ensure_ascii = False)
+    def write(self, force_save=False):
+        '''
+            label 단위 저장은 journal이 담당하고, 여기서는 master json 저장을 writer thread에 요청만 한다.
+            (work queue 모드에서는 record가 끝날 때마다 바로 commit)
+        '''
+        if force_save or self.work_queue is not None or (self.global_iter_cnt+1) % self.save_every == 0:
+            self._save()
             self._reset_global_iter_cnt()
 
     def _next_global_iter_cnt(self):
@@ -102,52 +259,152 @@ class ECG_GUI:
         self.patient_dict[patient_id]['annotation_info'].clear()
         self.patient_dict[patient_id]['is_annotated'] = False
         self.patient_dict[patient_id]['annotation_time'] = None
-        #self.write()
+        self.journal.append(patient_id, self.patient_dict[patient_id], 'revert')
+        self.changed_keys.add(patient_id)
         
         self._reset_global_iter_cnt()
        
 
-    def read_ecg_image(self, idx, time_step, global_step=None):
-        patient_id = self.idx_to_id[idx]
+    def _prefetch_keys(self, idx, time_step):
+        '''
+            현재 환자의 남은 time step -> 다음 미작업 환자들 -> (backspace 대비) 현재 / 이전 환자 앞 frame 순
+        '''
+        keys = [(idx, t) for t in range(time_step+1, 4)]
+
+        next_idx = idx + 1
+        while len(keys) < self.num_prefetch and next_idx < len(self.patient_idx_list):
+            if not self.is_annotated(next_idx):
+                keys += [(next_idx, t) for t in range(1, 4)]
+            next_idx += 1
+        keys = keys[:self.num_prefetch]
+
+        keys += [(idx, t) for t in range(1, time_step)]
+        if idx > 0:
+            keys.append((idx-1, 1))
+        return keys
+
+    def _read_base_image(self, patient_id, time_step):
+        if self.render_on_demand:
+            with self.render_lock:
+                img = self.renderer.draw_ecg_wave(patient_id, time_step)
+            # 렌더링 결과 (RGBA)를 png로 저장했다가 cv2.imread 한 것과 같은 3 channel 이미지
+            return np.ascontiguousarray(img[..., :3])
 
-        raw_LR_value      = self.patient_dict[patient_id]['LR'][(time_step-1)*2] 
-        denoised_LR_value = self.patient_dict[patient_id]['LR'][(time_step-1)*2  +1]
         file_name = self.patient_dict[patient_id]['img_name'][time_step-1]  #file name
         file_path = os.path.join(self.render_dir, file_name) #full path
+        return cv2.imread(file_path)
+
+    def reset_view(self):
+        self.zoom = 1
+        self.pan = 0.0 # time step 구간 중심에서 벗어난 정도 (구간 길이 단위)
+
+    def change_view(self, action):
+        if action == 'zoom_in':
+            self.zoom = min(self.zoom * 2, self.max_zoom)
+        elif action == 'zoom_out':
+            self.zoom = max(self.zoom // 2, 1)
+            if self.zoom == 1:
+                self.pan = 0.0
+        elif action == 'pan_left' and self.zoom > 1:
+            self.pan -= 0.5 / self.zoom # 화면 폭의 절반씩
+        elif action == 'pan_right' and self.zoom > 1:
+            self.pan += 0.5 / self.zoom
+        elif action == 'reset_view':
+            self.reset_view()
+
+    def _read_zoom_image(self, patient_id, time_step):
+        '''
+            time step 구간의 1/zoom 만큼을 pyramid envelope으로 그린다. (record 길이와 상관없이 일정한 비용)
+        '''
+        record = self.patient_dict[patient_id]
+        n = len(self.wave_store.get(record, 'raw_ecg_wave_voltage'))
+        chunk_size = n // 3
+        width = max(chunk_size / self.zoom, 1)
+
+        # 이동은 record 전체 범위 안에서만
+        center = (time_step-1) * chunk_size + chunk_size * (0.5 + self.pan)
+        start = min(max(center - width / 2, 0), max(n - width, 0))
+        stop = start + width
+        self.pan = (start + width / 2 - (time_step-1) * chunk_size) / max(chunk_size, 1) - 0.5
+
+        imgs = []
+        for wave_type, name in zip(WaveformStore.WAVE_TYPES, ('Original', 'Denoised')):
+            x, lo, hi = self.wave_store.get_envelope(record, wave_type, start, stop, self.zoom_drawer.plot_w)
+            imgs.append(self.zoom_drawer.draw_envelope(
+                x, lo, hi, (start, stop),
+                label = '{} {}/3 x{}'.format(name, time_step, self.zoom),
+                linewidth = self.zoom_line_width,
+                color = self.zoom_line_color
+            ))
+        img = cv2.vconcat(imgs)
+        height, width, _ = img.shape
+        img = cv2.line(img, (0, height//2), (width-1, height//2), (0,0,0))
+        return np.ascontiguousarray(img[..., :3])
 
-        img = cv2.imread(file_path)
+    def _load_frame(self, idx, time_step, zoomed=False):
+        '''
+            렌더링 이미지 + 환자 id / LR 값 overlay (진행 상황 표시는 제외)
+        '''
+        patient_id = self.idx_to_id[idx]
+
+        raw_LR_value      = self.patient_dict[patient_id]['LR'][(time_step-1)*2] 
+        denoised_LR_value = self.patient_dict[patient_id]['LR'][(time_step-1)*2  +1]
+        if zoomed:
+            img = self._read_zoom_image(patient_id, time_step)
+        else:
+            img = self._read_base_image(patient_id, time_step)
         height, width, _ = img.shape
 
         origin = (10, 30)
-        origin_pbar = (width-80, 30)
         origin_raw_lr = (width//2, 35)
         origin_denoised_lr = (width//2, height//2+35) #! TBD
 
         color = (0,0,0)        
         img = cv2.putText(img, str(patient_id), origin, cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+        img = cv2.putText(img, str(raw_LR_value), origin_raw_lr, cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+        img = cv2.putText(img, str(denoised_LR_value), origin_denoised_lr, cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+
+        if suggest_artifact(self.patient_dict[patient_id], time_step):
+            origin_suggest = (10, height-15)
+            img = cv2.putText(img, 'artifact? (Enter)', origin_suggest, cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,0,255), 2)
+
+        return img
+
+    @instrument.span('gui.read_ecg_image')
+    def read_ecg_image(self, idx, time_step, global_step=None):
+        if self.zoom > 1: # 확대 화면은 매번 그리고 cache에 넣지 않는다
+            img = self._load_frame(idx, time_step, zoomed=True)
+        elif self.prefetcher is not None:
+            img = self.prefetcher.get((idx, time_step)).copy() # cache 원본에는 그리지 않음
+            self.prefetcher.request(self._prefetch_keys(idx, time_step))
+        else:
+            img = self._load_frame(idx, time_step)
 
         if global_step is not None:
+            height, width, _ = img.shape
+            origin_pbar = (width-80, 30)
+            color = (0,0,0)
             img = cv2.putText(img, str(global_step), origin_pbar, cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-        
-        img = cv2.putText(img, str(raw_LR_value), origin_raw_lr, cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-        img = cv2.putText(img, str(denoised_LR_value), origin_denoised_lr, cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
 
         return img
         
     def analysis(self, idx): # current patient index (not always starts from 0)
         
         time_step = 1 # 1, 2, 3
+        self.reset_view()
         while True:
             if time_step > 3:
                 break
             
             patient_ecg_wave_img = self.read_ecg_image( # self.num_already_done
-                idx, time_step, global_step= '{} / {}'.format(self.curr_patient_index+1 - self.num_already_done, self.length
-            ))
+                idx, time_step, global_step=self._progress_text()
+            )
             cv2.imshow(self.ecg_window_name, patient_ecg_wave_img)
             cv2.imshow(self.button_window_name, self.button_img)
+            self._key_span.stop() # 직전 key 입력 -> 다음 화면 imshow 까지
 
             user_key = cv2.waitKey(0) & 0xff 
+            self._key_span = instrument.span('gui.key_to_imshow').start()
 
             if user_key == 27: # ESC
                 return 'EXIT'
@@ -156,10 +413,18 @@ class ECG_GUI:
                 self.prev_step()
                 print('back space')
                 return 'PREV'
+            elif chr(user_key) in self.view_key_dict:
+                self.change_view(self.view_key_dict[chr(user_key)])
+            elif user_key in (10, 13): # Enter : 제안된 'artifact' 수락
+                if suggest_artifact(self.patient_dict[self.idx_to_id[idx]], time_step):
+                    time_step += 1
+                    self.reset_view()
+                    self.commit_annotation('artifact')
             else:
                 for key in self.key_dict:
                     if user_key == ord(key):
                         time_step += 1
+                        self.reset_view()
                         self.commit_annotation(self.key_dict[key])
                         break
         
@@ -177,6 +442,27 @@ class ECG_GUI:
         if self.curr_patient_index < 0:
             self.curr_patient_index = 0
 
+    def _progress_text(self):
+        if self.work_queue is not None: # 모든 annotator 합계
+            status = self.work_queue.status()
+            return '{} / {}'.format(status['done'] + 1, sum(status.values()))
+        return '{} / {}'.format(self.curr_patient_index+1 - self.num_already_done, self.length)
+
+    def _first_unannotated_index(self):
+        '''
+            sqlite master는 is_annotated index query로 앞쪽의 작업된 record를 건너뛴다.
+        '''
+        if not isinstance(self.patient_dict, SQLiteMasterStore):
+            return 0
+        if self.order_by_quality: # 보여주는 순서가 master 순서와 다름
+            indices = [self.id_to_idx[key] for key in self.patient_dict.unannotated_keys()]
+            return min(indices, default=len(self.patient_idx_list))
+
+        patient_id = self.patient_dict.next_unannotated()
+        if patient_id is None:
+            return len(self.patient_idx_list)
+        return self.id_to_idx[patient_id]
+
     def is_annotated(self, idx):
         patient_id = self.idx_to_id[idx]
         return self.patient_dict[patient_id]['is_annotated'] == True
@@ -185,7 +471,21 @@ class ECG_GUI:
         cv2.namedWindow(self.ecg_window_name, cv2.WINDOW_NORMAL)
         cv2.namedWindow(self.button_window_name, cv2.WINDOW_NORMAL)
 
-        self.curr_patient_index = 0
+        if self.work_queue is not None:
+            self._run_queue()
+        else:
+            self._run_local()
+
+        self.write(force_save=True)
+        if self.autosave is not None and not self.autosave.close(): # 남은 저장이 끝날 때까지 대기
+            print('master json not saved, annotations are kept in {}'.format(self.journal.journal_path))
+        if self.work_queue is not None:
+            self.work_queue.close()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+    def _run_local(self):
+        self.curr_patient_index = self._first_unannotated_index()
         while True:
             if self.curr_patient_index == len(self.patient_idx_list):
                 break
@@ -199,13 +499,39 @@ class ECG_GUI:
             else:
                 self.next_step()
 
-        self.write(force_save=True)
+    def _run_queue(self):
+        '''
+            대기열에서 lease 받은 record만 작업한다. (backspace는 현재 record를 처음부터 다시)
+        '''
+        while True:
+            patient_id = self.work_queue.acquire()
+            if patient_id is None:
+                break
+            idx = self.id_to_idx[patient_id]
+            print('[{}] patient {}'.format(self.work_queue.annotator, patient_id))
+
+            if self.is_annotated(idx): # journal에서 복구된 완료 record
+                self.changed_keys.add(patient_id)
+                self._save()
+                continue
+
+            while not self.is_annotated(idx):
+                self.curr_patient_index = idx
+                if self.analysis(idx) == 'EXIT':
+                    # 작업 중이던 record는 label을 지우고 대기열에 반납
+                    self.revert_annotation()
+                    self.changed_keys.discard(patient_id)
+                    self._save()
+                    self.work_queue.release(patient_id)
+                    return
 
 def opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--master_json', type=str, default='./sample2.json')               # master json 파일 경로
     parser.add_argument('--button', type=str, default='./resource/ecg_button.drawio.png')    # user ux ui 버튼 이미지
     parser.add_argument('--render_dir', type=str, default='./render_vis')                    # # 렌더링 결과가 저장될 경로
+    parser.add_argument('--work_queue', type=str, default=None)                              # 여러 명이 같이 작업할 때 공유하는 대기열 db (work_queue.py)
+    parser.add_argument('--annotator', type=str, default=None)                               # 작업자 이름 (default: 로그인 사용자)
     return parser.parse_args()
 
 def main():
@@ -220,7 +546,17 @@ def main():
         line_color = '#e35f62', # figure line 색상 #! update
         buttonsize=(800, 300),  # button size 
         force_render = False,   #! True로 설정시 렌더링 초기화 (전체 영상 다시 생성)
+        render_workers = 1,     # 렌더링 process 수
+        drawer = 'matplotlib',  # ecg wave backend ('matplotlib' or 'raster')
+        reuse_figure = True,    # matplotlib figure 재사용 (출력 동일, strip 당 setup 비용 제거)
         save_every = 20,        #! 자동 세이브 period (환자 20명작업 마다 자동 세이브)
+        prefetch = 6,           # 미리 읽어둘 다음 frame 수 (0이면 사용 안 함)
+        render_on_demand = False, #! True로 설정시 사전 렌더링 없이 화면에 띄울 때 바로 그림
+        max_zoom = 64,          # '+'/'=' 확대, '-' 축소, '[' / ']' 이동, '0' 원래 화면
+        order_by_quality = True, # quality.py 결과가 있으면 깨끗한 record부터 작업
+        work_queue = args.work_queue, # 대기열 db 경로 (None이면 혼자 작업)
+        annotator = args.annotator,
+        lease_seconds = 600,    # record 하나를 빌려두는 시간 (label 입력마다 연장)
     )
 
     app.run()
@@ -0,0 +1,118 @@
+import os
+import threading
+
+from collections import OrderedDict
+
+
+class FrameCache:
+    '''
+        GUI에 띄울 frame (np.ndarray) LRU cache. GUI thread와 prefetch thread가 같이 사용한다.
+
+        max_items (frame 개수), max_bytes (frame nbytes 합) 중 설정된 한도를 넘으면 오래된 것부터 버린다.
+    '''
+    def __init__(self, max_items=32, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _over_budget(self):
+        if self.max_items is not None and len(self._frames) > self.max_items:
+            return True
+        if self.max_bytes is not None and self.num_bytes > self.max_bytes:
+            return len(self._frames) > 1 # 방금 넣은 frame 하나는 남긴다
+        return False
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._frames:
+                return None
+            self._frames.move_to_end(key)
+            return self._frames[key]
+
+    def put(self, key, frame):
+        with self._lock:
+            if key in self._frames:
+                self.num_bytes -= self._frames[key].nbytes
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            self.num_bytes += frame.nbytes
+            while self._over_budget():
+                _, evicted = self._frames.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._frames
+
+    def __len__(self):
+        with self._lock:
+            return len(self._frames)
+
+
+class FramePrefetcher:
+    '''
+        loader(key) -> frame 를 background thread에서 미리 실행해 FrameCache를 채우는 기능
+
+        request()로 받은 key 목록이 이전 요청을 대체하므로, 사용자가 빨리 넘겨도
+        이미 지나간 frame은 읽지 않는다.
+        low_priority=True 이면 (linux) thread의 nice 값을 올려 GUI thread보다 늦게 스케줄되게 한다.
+    '''
+    def __init__(self, loader, cache, low_priority=False):
+        self.loader = loader
+        self.cache = cache
+        self.low_priority = low_priority
+
+        self._wanted = []
+        self._stop = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, keys):
+        with self._cond:
+            self._wanted = [key for key in keys if key not in self.cache]
+            self._cond.notify()
+
+    def get(self, key):
+        '''
+            cache에 있으면 바로 리턴하고, 없으면 현재 thread에서 읽는다.
+        '''
+        frame = self.cache.get(key)
+        if frame is None:
+            frame = self.loader(key)
+            self.cache.put(key, frame)
+        return frame
+
+    def _lower_priority(self):
+        try: # linux에서는 thread 단위로 nice 값이 적용된다
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+
+    def _run(self):
+        if self.low_priority:
+            self._lower_priority()
+
+        while True:
+            with self._cond:
+                while len(self._wanted) == 0 and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                key = self._wanted.pop(0)
+
+            if key in self.cache:
+                continue
+            try:
+                frame = self.loader(key)
+            except Exception: # 화면에 띄울 때 get()에서 다시 읽으며 에러가 드러난다
+                continue
+            self.cache.put(key, frame)
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join()
@@ -1,7 +1,10 @@
 import os
+import csv
 import json
 import argparse
 
+from concurrent.futures import ThreadPoolExecutor
+
 def _parse_id_json(json_path):
     if not os.path.isfile(json_path):
         with open(json_path, 'w') as f:
@@ -13,39 +16,148 @@ def _parse_id_json(json_path):
     return data
 
 
-def _get_name_from_csv(csv_file):
-    return '홍길동2'
-
+# csv 앞부분에서 환자 이름이 들어있는 행의 첫 번째 column 값
+NAME_FIELDS = ('name', '이름', '성명', 'patient name')
+
+def _get_name_from_csv(csv_file, max_bytes=4096):
+    '''
+        csv header (앞 max_bytes 만큼)에서 'Name,홍길동' 형태의 행을 찾아 이름을 리턴, 없으면 None
+    '''
+    try:
+        with open(csv_file, 'r', encoding='utf-8-sig', errors='replace') as f:
+            head = f.read(max_bytes)
+    except OSError:
+        return None
+
+    lines = head.splitlines()
+    if len(head) == max_bytes and len(lines) > 1: # 잘린 마지막 줄은 버림
+        lines = lines[:-1]
+
+    for row in csv.reader(lines):
+        if len(row) >= 2 and row[0].strip().lower() in NAME_FIELDS:
+            name = row[1].strip()
+            if len(name) > 0:
+                return name
+    return None
+
+
+def _load_manifest(manifest_path):
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def _scan_patient_dir(csv_dir, prev):
+    '''
+        환자 디렉토리 하나를 읽어 manifest entry를 만든다.
+        디렉토리 mtime이 같으면 (파일 추가 / 삭제 / 이름 변경 없음) 디렉토리 안을 읽지 않고 이전 결과를 재사용한다.
+        scan 도중 디렉토리가 사라지면 (None, True)
+    '''
+    try:
+        dir_mtime = os.stat(csv_dir).st_mtime_ns
+        if prev is not None and prev.get('mtime') == dir_mtime:
+            return prev, False
+
+        files = {}
+        with os.scandir(csv_dir) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+                except FileNotFoundError: # scandir 이후 지워진 파일
+                    continue
+    except FileNotFoundError:
+        return None, True
+
+    name = None
+    if prev is not None and prev.get('name') is not None and prev.get('files'):
+        # 이미 이름을 찾은 파일이 그대로면 다시 읽지 않음
+        if prev.get('name_from') in files and prev['files'].get(prev['name_from']) == files[prev['name_from']]:
+            name = prev['name']
+
+    name_from = prev.get('name_from') if name is not None else None
+    if name is None:
+        for csv_file in sorted(files):
+            name = _get_name_from_csv(os.path.join(csv_dir, csv_file))
+            if name is not None:
+                name_from = csv_file
+                break
+
+    return {
+        'mtime' : dir_mtime,
+        'files' : files,
+        'name' : name,
+        'name_from' : name_from,
+    }, True
+
+
+def _walk_csv(csv_root, manifest=None, num_workers=8):
+    '''
+        args:
+            manifest (dict) : 이전 scan 결과 (patient id -> 디렉토리 mtime, 파일 목록, 이름)
+                              바뀐 디렉토리만 다시 읽고, 갱신된 manifest를 in-place로 반영
+            num_workers (int) : 디렉토리 scan thread 수 (network share 등 느린 storage용)
+    '''
+    if manifest is None:
+        manifest = {}
+
+    with os.scandir(csv_root) as it:
+        patient_dirs = [(entry.name, entry.path) for entry in it if entry.is_dir()]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(_scan_patient_dir, csv_dir, manifest.get(patient_id))
+            for patient_id, csv_dir in patient_dirs
+        ]
+        results = [future.result() for future in futures]
 
-def _walk_csv(csv_root):
     ret = {}
+    num_changed = 0
+    for (patient_id, _), (entry, changed) in zip(patient_dirs, results):
+        if entry is None: # scan 도중 삭제된 디렉토리 (아래에서 manifest에서도 지움)
+            continue
+        manifest[patient_id] = entry
+        num_changed += int(changed)
 
-    for patient_id in os.listdir(csv_root):
-        csv_dir = os.path.join(csv_root, patient_id)
         ret[patient_id] = {}
-        ret[patient_id]['csv'] = []
-        ret[patient_id]['name'] = None
-
-        for csv_file in os.listdir(csv_dir):
-            if ret[patient_id]['name'] is None:
-                ret[patient_id]['name'] = _get_name_from_csv(os.path.join(csv_dir, csv_file))
-            ret[patient_id]['csv'].append(csv_file)
+        ret[patient_id]['csv'] = sorted(entry['files'])
+        ret[patient_id]['name'] = entry['name']
 
+    for patient_id in [p for p in manifest if p not in ret]: # 삭제된 디렉토리
+        del manifest[patient_id]
 
+    print('{} / {} patient directories changed'.format(num_changed, len(ret)))
     return ret
 
 class PatientIDGenerator:
-    def __init__(self, csv_root_dir, json_path):
+    def __init__(self, csv_root_dir, json_path, **kwargs):
         self.csv_root_dir = csv_root_dir
         self.json_path = json_path
 
+        # 디렉토리 mtime / 파일 크기 manifest (변경된 디렉토리만 다시 scan)
+        self.manifest_path = kwargs.get('manifest_path')
+        if self.manifest_path is None:
+            self.manifest_path = json_path + '.manifest'
+        self.manifest = _load_manifest(self.manifest_path)
+
+        num_workers = kwargs.get('num_workers')
+        if num_workers is None:
+            num_workers = 8
+
         self.patient_dict = _parse_id_json(self.json_path)
-        self.new_patient_dict = _walk_csv(self.csv_root_dir)
+        self.new_patient_dict = _walk_csv(self.csv_root_dir, self.manifest, num_workers)
 
     def run(self):
         self.patient_dict.update( self.new_patient_dict )
         with open(self.json_path, 'w') as f:
             json.dump(self.patient_dict, f, indent = '\t', ensure_ascii = False)
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f, ensure_ascii = False)
 
 
 
@@ -56,6 +168,7 @@ def opt():
     parser.add_argument('--csv_root_dir', type = str, 
                         default='/home/compu/Projects/arrhythmia/diagnosis/patient_ecg')
     parser.add_argument('--id_json', type=str, default='./id_generator.json')
+    parser.add_argument('--num_workers', type=int, default=8)      # 디렉토리 scan thread 수
     return parser.parse_args()
 
 def main():
@@ -63,7 +176,8 @@ def main():
 
     app = PatientIDGenerator(
         csv_root_dir = args.csv_root_dir,     # 환자 csv 루트 디렉토리  
-        json_path = args.id_json              # 결과 json 저장 경로 
+        json_path = args.id_json,             # 결과 json 저장 경로 
+        num_workers = args.num_workers        # 디렉토리 scan thread 수
     )
     app.run()
 
@@ -0,0 +1,264 @@
+import os
+import re
+import json
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import parse_json, write_json, lock_master
+from waveform_store import WaveformStore
+from patient_index import PatientIndex
+
+
+# header 행에서 측정 시각 / sampling rate를 찾을 때 쓰는 이름
+RECORDED_TIME_FIELDS = ('recorded date', 'recorded time', '측정 일시', '측정일시')
+SAMPLE_RATE_FIELDS = ('sample rate', 'sampling rate')
+
+# A-2106161442_ecg_2021-06-16_18.csv -> 2021-06-16 18
+_FILE_TIME = re.compile(r'_ecg_(\d{4}-\d{2}-\d{2})_(\d+)')
+
+
+def _is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def read_watch_csv(csv_path, chunk_lines=65536):
+    '''
+        watch csv를 header 행 (key,value) 과 voltage 열로 나눠 읽는다.
+        voltage는 chunk_lines 줄씩 np.loadtxt로 parsing 하여 파일 전체 문자열을 메모리에 올리지 않는다.
+
+        return:
+            header (dict), voltage (np.ndarray, float32)
+    '''
+    header = {}
+    chunks = []
+    with open(csv_path, 'r', encoding='utf-8-sig', errors='replace') as f:
+        first_data_line = None
+        for line in f:
+            row = line.strip().split(',')
+            if len(row[0]) == 0:
+                continue
+            if _is_number(row[0]):
+                first_data_line = line
+                break
+            if len(row) >= 2:
+                header[row[0].strip().lower()] = ','.join(row[1:]).strip().strip('"')
+
+        lines = [first_data_line] if first_data_line is not None else []
+        while True:
+            lines += f.readlines(chunk_lines * 16)
+            lines = [line for line in lines if line.strip()]
+            if len(lines) == 0:
+                break
+            chunks.append(np.loadtxt(lines, delimiter=',', usecols=0, ndmin=1, dtype=np.float32))
+            lines = []
+
+    if len(chunks) == 0:
+        return header, np.zeros(0, dtype=np.float32)
+    return header, np.concatenate(chunks)
+
+
+def get_sample_rate(header, default=512.0):
+    for field in SAMPLE_RATE_FIELDS:
+        if field in header:
+            match = re.search(r'[\d.]+', header[field])
+            if match is not None:
+                return float(match.group())
+    return default
+
+
+def get_recorded_time(header, csv_file):
+    for field in RECORDED_TIME_FIELDS:
+        if field in header:
+            return header[field]
+    match = _FILE_TIME.search(csv_file)
+    if match is not None:
+        return '{} {}'.format(match.group(1), match.group(2))
+    return None
+
+
+def denoise(raw, fs):
+    '''
+        baseline wander 제거 (약 0.75s moving average) + 짧은 moving average smoothing
+    '''
+    if len(raw) == 0:
+        return raw
+    raw = raw.astype(np.float64)
+
+    window = max(int(fs * 0.75), 1)
+    kernel = np.ones(window) / window
+    padded = np.pad(raw, (window//2, window - 1 - window//2), mode='edge')
+    baseline = np.convolve(padded, kernel, mode='valid')
+
+    smooth = max(int(fs * 0.01), 1)
+    kernel = np.ones(smooth) / smooth
+    detrended = raw - baseline
+    padded = np.pad(detrended, (smooth//2, smooth - 1 - smooth//2), mode='edge')
+    return np.convolve(padded, kernel, mode='valid').astype(np.float32)
+
+
+def make_master_record(patient_id, csv_file, recorded_time, wave_file):
+    return {
+        'LR' : [None] * 6,      # 모델 출력 전
+        'wave_file' : wave_file,
+        'is_printed' : False,
+        'is_annotated' : False,
+        'annotation_info' : [],
+        'annotation_time' : None,
+        'recorded_time' : recorded_time,
+        'patient_id' : patient_id,
+    }
+
+
+# worker process 당 하나씩 생성
+_worker_store = None
+
+def _init_ingest_worker(wave_dir):
+    global _worker_store
+    _worker_store = WaveformStore(wave_dir)
+
+def _ingest_worker(task):
+    '''
+        csv 하나 -> waveform store에 wave 저장 후 master record (metadata) 리턴
+    '''
+    patient_id, csv_path = task
+    csv_file = os.path.basename(csv_path)
+    try:
+        header, raw = read_watch_csv(csv_path)
+        denoised = denoise(raw, get_sample_rate(header))
+        wave_file = _worker_store.write(csv_file, raw, denoised)
+    except Exception as e: # 실패한 파일은 journal에 남기지 않으므로 다음 실행에서 다시 시도
+        return csv_file, None, repr(e)
+
+    record = make_master_record(patient_id, csv_file, get_recorded_time(header, csv_file), wave_file)
+    return csv_file, record, None
+
+
+class IngestPipeline:
+    '''
+        id_generator 결과 (patient id -> csv 목록) 에서 master json record + binary waveform 을 만드는 기능
+
+        - csv 단위로 process pool에 분배, wave는 worker가 WaveformStore에 바로 저장
+        - 끝난 record는 '<master_json>.ingest' journal에 한 줄씩 append (중단 후 다시 실행하면 이어서 진행)
+        - 마지막에 journal을 master json에 합치고 patient index를 갱신
+    '''
+    def __init__(self, **kwargs):
+        self.csv_root_dir = kwargs.get('csv_root_dir')
+        self.id_json = kwargs.get('id_json')
+        self.json_path = kwargs.get('master_json')
+        self.journal_path = self.json_path + '.ingest'
+
+        self.wave_dir = kwargs.get('wave_dir')
+        if self.wave_dir is None:
+            self.wave_dir = WaveformStore.default_dir(self.json_path)
+
+        self.num_workers = kwargs.get('num_workers')
+        if self.num_workers is None:
+            self.num_workers = os.cpu_count() or 1
+
+    def _load_journal(self):
+        done = {}
+        if not os.path.isfile(self.journal_path):
+            return done
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError: # 중단 시 잘린 마지막 줄
+                    continue
+                done[entry['key']] = entry['record']
+        return done
+
+    def _get_tasks(self, existing_keys, done):
+        with open(self.id_json, 'r') as f:
+            id_dict = json.load(f)
+
+        tasks = []
+        for patient_id in sorted(id_dict):
+            for csv_file in sorted(id_dict[patient_id]['csv']):
+                if csv_file in existing_keys or csv_file in done:
+                    continue
+                tasks.append((patient_id, os.path.join(self.csv_root_dir, patient_id, csv_file)))
+        return tasks
+
+    def _merge(self, done):
+        '''
+            lock을 잡고 디스크의 master를 다시 읽어 journal의 record를 합치고 journal 삭제
+            (ingest 도중 ECG_GUI / report가 저장한 내용을 덮어쓰지 않도록)
+        '''
+        with lock_master(self.json_path):
+            if not os.path.isfile(self.json_path):
+                write_json(self.json_path, {})
+            patient_dict, _ = parse_json(self.json_path, lazy=True)
+            try:
+                for key in sorted(done):
+                    if key not in patient_dict:
+                        patient_dict[key] = done[key]
+
+                write_json(self.json_path, patient_dict)
+                PatientIndex(self.json_path).update(patient_dict) # 새로 추가된 key만 읽어서 반영
+            finally:
+                patient_dict.close()
+        os.remove(self.journal_path)
+
+    def __call__(self):
+        existing_keys = set()
+        if os.path.isfile(self.json_path):
+            patient_dict, _ = parse_json(self.json_path, lazy=True)
+            existing_keys = set(patient_dict.keys())
+            patient_dict.close()
+
+        done = self._load_journal()
+        tasks = self._get_tasks(existing_keys, done)
+        print('{} csv files to ingest ({} resumed from journal)'.format(len(tasks), len(done)))
+
+        num_failed = 0
+        with open(self.journal_path, 'a', encoding='utf-8') as journal, \
+             ProcessPoolExecutor(
+                 max_workers = self.num_workers,
+                 initializer = _init_ingest_worker,
+                 initargs = (self.wave_dir,)
+             ) as executor:
+            for key, record, error in tqdm(executor.map(_ingest_worker, tasks, chunksize=8), total=len(tasks)):
+                if error is not None:
+                    print('failed : {} ({})'.format(key, error))
+                    num_failed += 1
+                    continue
+                journal.write(json.dumps({'key' : key, 'record' : record}, ensure_ascii = False) + '\n')
+                journal.flush()
+                done[key] = record
+
+        self._merge(done)
+        print('{} records added to {} ({} failed)'.format(len(done), self.json_path, num_failed))
+
+
+def opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv_root_dir', type = str,
+                        default='/home/compu/Projects/arrhythmia/diagnosis/patient_ecg')   # 환자 csv 루트 디렉토리
+    parser.add_argument('--id_json', type=str, default='./id_generator.json')             # id_generator 결과 json
+    parser.add_argument('--master_json', type=str, default='./master_ecg.json')           # 결과 master json
+    parser.add_argument('--wave_dir', type=str, default=None)                             # binary wave 저장 경로 (default: <master_json>_wave)
+    parser.add_argument('--num_workers', type=int, default=None)                          # csv parsing process 수 (default: cpu 수)
+    return parser.parse_args()
+
+def main():
+    args = opt()
+
+    IngestPipeline(
+        csv_root_dir = args.csv_root_dir,
+        id_json = args.id_json,
+        master_json = args.master_json,
+        wave_dir = args.wave_dir,
+        num_workers = args.num_workers,
+    )()
+
+if __name__ == '__main__':
+    main()
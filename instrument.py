@@ -0,0 +1,328 @@
+'''
+    이름 붙은 구간 (span) 소요 시간과 counter를 모아 종료 시 파일로 남기는 기능
+
+    환경 변수 WATCH_ECG_PROFILE 로 켠다. (import 시점에 한 번만 읽음)
+        - 없음 / 0 : 꺼짐. span()은 아무것도 하지 않는 객체를, decorator는 함수를 그대로 돌려준다.
+        - 1        : ./watch_ecg_profile.json
+        - 경로     : .prom 이면 Prometheus textfile, 그 외에는 json
+    worker process는 종료 시 같은 파일에 lock을 잡고 자기 값을 합친다. (실행 단위로 합치고 이전 실행 값은 버림)
+    span은 고정 bucket의 histogram으로 남기므로 process 별 값을 그대로 더할 수 있다.
+
+    ex)
+        with instrument.span('render.imwrite'):
+            cv2.imwrite(path, img)
+
+        @instrument.span('parse_json')
+        def parse_json(...):
+
+        instrument.count('render.cache_miss')
+'''
+
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+import contextlib
+import multiprocessing
+import multiprocessing.util
+
+import numpy as np
+
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+
+ENV_NAME = 'WATCH_ECG_PROFILE'
+DEFAULT_PATH = './watch_ecg_profile.json'
+RUN_ENV_NAME = 'WATCH_ECG_PROFILE_RUN'
+QUANTILES = (0.5, 0.9, 0.99)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STATE_PREFIX = '# watch_ecg_state '
+
+
+def _get_output_path():
+    value = os.environ.get(ENV_NAME, '').strip()
+    if value.lower() in ('', '0', 'false', 'off'):
+        return None
+    if value.lower() in ('1', 'true', 'on'):
+        return DEFAULT_PATH
+    return value
+
+output_path = _get_output_path()
+enabled = output_path is not None
+
+# 실행 구분용 id. 처음 import 한 process가 정하고 환경 변수로 자식 process에 물려준다
+# (spawn worker는 import 시점에 아직 parent_process()가 None 이므로 이미 있으면 그대로 쓴다)
+if enabled:
+    os.environ.setdefault(RUN_ENV_NAME, '{}-{}'.format(os.getpid(), time.time_ns()))
+run_id = os.environ.get(RUN_ENV_NAME)
+
+_spans = {}     # span 이름 -> 소요 시간 (초) list
+_counters = {}  # counter 이름 -> 누적 값
+_lock = threading.Lock()
+_hook_pid = None
+
+
+def _ensure_exit_hook():
+    '''
+        process 마다 처음 기록할 때 한 번 종료 hook을 건다.
+        fork 된 worker는 부모가 모은 값을 물려받으므로 비우고 시작한다.
+    '''
+    global _hook_pid
+    pid = os.getpid()
+    if _hook_pid == pid:
+        return
+    with _lock:
+        if _hook_pid == pid:
+            return
+        if _hook_pid is not None:
+            _spans.clear()
+            _counters.clear()
+        _hook_pid = pid
+        if multiprocessing.parent_process() is None:
+            atexit.register(dump)
+        else: # multiprocessing worker는 atexit 대신 finalizer만 실행하고 종료된다
+            multiprocessing.util.Finalize(None, dump, exitpriority=0)
+
+
+def observe(name, seconds):
+    if not enabled:
+        return
+    _ensure_exit_hook()
+    samples = _spans.get(name)
+    if samples is None:
+        samples = _spans.setdefault(name, [])
+    samples.append(seconds)
+
+def count(name, value=1):
+    if not enabled:
+        return
+    _ensure_exit_hook()
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+class Span:
+    '''
+        with 문, decorator, start() / stop() 로 쓸 수 있는 구간 timer
+    '''
+    __slots__ = ('name', '_start')
+
+    def __init__(self, name):
+        self.name = name
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        return self
+
+    def stop(self):
+        if self._start is None:
+            return
+        observe(self.name, time.perf_counter() - self._start)
+        self._start = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __call__(self, func):
+        return func
+
+_NULL_SPAN = _NullSpan()
+
+def span(name):
+    if not enabled:
+        return _NULL_SPAN
+    return Span(name)
+
+
+def estimate_quantile(entry, le, q):
+    '''
+        bucket 누적 개수로 q 분위수 추정 (bucket 안에서는 선형 보간, 양 끝은 min / max 로 제한)
+    '''
+    rank = q * entry['count']
+    lower, prev = entry['min'], 0
+    for upper, cum in zip(list(le) + [float('inf')], entry['buckets'] + [entry['count']]):
+        upper = min(upper, entry['max'])
+        if cum >= rank and cum > prev:
+            return lower + (upper - lower) * (rank - prev) / (cum - prev)
+        lower, prev = max(upper, entry['min']), cum
+    return entry['max']
+
+def _add_quantiles(stats):
+    for entry in stats['spans'].values():
+        for q in QUANTILES:
+            entry['p{:g}'.format(q * 100)] = estimate_quantile(entry, stats['le'], q)
+    return stats
+
+def _merge_span(a, b):
+    a['count'] += b['count']
+    a['sum'] += b['sum']
+    a['min'] = min(a['min'], b['min'])
+    a['max'] = max(a['max'], b['max'])
+    a['mean'] = a['sum'] / a['count']
+    a['buckets'] = [x + y for x, y in zip(a['buckets'], b['buckets'])]
+    return a
+
+def merge(stats, other):
+    '''
+        summary() 결과 두 개를 합친다. (bucket 경계가 다르면 other를 버림)
+    '''
+    if other.get('le') != stats['le']:
+        return stats
+    for name, entry in other['spans'].items():
+        if name in stats['spans']:
+            _merge_span(stats['spans'][name], entry)
+        else:
+            stats['spans'][name] = dict(entry)
+    for name, value in other['counters'].items():
+        stats['counters'][name] = stats['counters'].get(name, 0) + value
+    stats['spans'] = dict(sorted(stats['spans'].items()))
+    stats['counters'] = dict(sorted(stats['counters'].items()))
+    return _add_quantiles(stats)
+
+def summary():
+    '''
+        span 별 count / sum / mean / min / max (초), bucket 별 누적 개수 (le 이하), counter 값
+        분위수 (p50, p90, p99)는 process 끼리 합칠 수 있도록 bucket 에서 추정한다.
+    '''
+    spans = {}
+    for name, samples in sorted(_spans.items()):
+        if len(samples) == 0:
+            continue
+        x = np.asarray(samples, dtype=np.float64)
+        spans[name] = {
+            'count' : int(x.size),
+            'sum' : float(x.sum()),
+            'mean' : float(x.mean()),
+            'min' : float(x.min()),
+            'max' : float(x.max()),
+            'buckets' : np.searchsorted(np.sort(x), BUCKETS, side='right').tolist(),
+        }
+    return _add_quantiles({'le' : list(BUCKETS), 'spans' : spans, 'counters' : dict(sorted(_counters.items()))})
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def to_prometheus(stats, labels=None):
+    '''
+        args:
+            labels (dict) : 모든 metric에 붙일 label
+    '''
+    extra = ''.join(',{}="{}"'.format(k, _escape(v)) for k, v in (labels or {}).items())
+    lines = []
+    if len(stats['spans']) > 0:
+        lines.append('# HELP watch_ecg_span_seconds time spent in a named span')
+        lines.append('# TYPE watch_ecg_span_seconds histogram')
+        for name, entry in stats['spans'].items():
+            label = 'span="{}"'.format(_escape(name)) + extra
+            for le, value in zip(stats['le'], entry['buckets']):
+                lines.append('watch_ecg_span_seconds_bucket{{{},le="{!r}"}} {}'.format(label, le, value))
+            lines.append('watch_ecg_span_seconds_bucket{{{},le="+Inf"}} {}'.format(label, entry['count']))
+            lines.append('watch_ecg_span_seconds_sum{{{}}} {!r}'.format(label, entry['sum']))
+            lines.append('watch_ecg_span_seconds_count{{{}}} {}'.format(label, entry['count']))
+    if len(stats['counters']) > 0:
+        lines.append('# HELP watch_ecg_events_total named event counter')
+        lines.append('# TYPE watch_ecg_events_total counter')
+        for name, value in stats['counters'].items():
+            lines.append('watch_ecg_events_total{{counter="{}"{}}} {}'.format(_escape(name), extra, value))
+    return '\n'.join(lines) + '\n'
+
+@contextlib.contextmanager
+def _lock_file(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _load(path):
+    '''
+        이전에 저장한 값. (.prom 은 주석 줄에 같이 남긴 json) 없거나 깨졌으면 None
+    '''
+    try:
+        with open(path) as f:
+            if os.path.splitext(path)[1] != '.prom':
+                return json.load(f)
+            for line in f:
+                if line.startswith(STATE_PREFIX):
+                    return json.loads(line[len(STATE_PREFIX):])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def dump(path=None):
+    '''
+        지금까지 모은 값을 path (None이면 WATCH_ECG_PROFILE 경로)에 저장. 기록이 없으면 쓰지 않는다.
+        같은 실행의 다른 process가 먼저 저장한 값이 있으면 합쳐서 저장한다.
+    '''
+    if path is None:
+        if output_path is None:
+            return None
+        path = output_path
+    if len(_spans) == 0 and len(_counters) == 0:
+        return None
+
+    stats = summary()
+    with _lock_file(path):
+        prev = _load(path)
+        pids = [os.getpid()]
+        if prev is not None and run_id is not None and prev.get('run') == run_id:
+            merge(stats, prev)
+            pids = prev.get('pids', []) + pids
+        stats = dict(created=str(datetime.now()), run=run_id, pids=pids, argv=sys.argv, **stats)
+
+        if os.path.splitext(path)[1] == '.prom':
+            # textfile collector는 HELP / TYPE 이 아닌 주석 줄을 무시한다
+            text = to_prometheus(stats) + STATE_PREFIX + json.dumps(stats, ensure_ascii = False) + '\n'
+        else:
+            text = json.dumps(stats, indent='\t', ensure_ascii = False)
+
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    return path
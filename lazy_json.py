@@ -0,0 +1,307 @@
+import os
+import re
+import json
+import zlib
+import codecs
+
+from collections.abc import MutableMapping
+
+
+_WS = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+
+def build_offset_index(f, chunk_size=1<<24):
+    '''
+        열린 master json (binary file)을 chunk 단위로 읽으며 top-level key -> (byte offset, length) 인덱스를 만든다.
+        record 경계는 json.JSONDecoder.raw_decode (C 구현)로 찾고, 파일 전체를 메모리에 올리지 않는다.
+    '''
+    index = {}
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    f.seek(0)
+
+    buf = ''
+    pos = 0       # buf 안의 현재 위치
+    byte_pos = 0  # pos의 파일 byte offset
+    eof = False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        data = f.read(chunk_size)
+        eof = not data
+        buf = buf[pos:] + decoder.decode(data, final=eof) # 이미 읽은 부분은 버림
+        pos = 0
+
+    def advance(new_pos):
+        nonlocal pos, byte_pos
+        byte_pos += len(buf[pos:new_pos].encode('utf-8'))
+        pos = new_pos
+
+    def skip_ws():
+        while True:
+            advance(_WS.match(buf, pos).end())
+            if pos < len(buf) or eof:
+                return
+            read_more()
+
+    def decode():
+        # chunk 끝에서 잘린 값이면 더 읽고 다시 시도
+        while True:
+            try:
+                _, end = _decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    return end
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_more()
+
+    def expect(chars):
+        skip_ws()
+        ch = buf[pos:pos+1]
+        if ch == '' or ch not in chars:
+            raise ValueError('{!r} expected at byte {}, got {!r}'.format(chars, byte_pos, ch))
+        advance(pos + 1)
+        return ch
+
+    expect('{')
+    skip_ws()
+    if buf[pos:pos+1] == '}':
+        return index
+
+    while True:
+        skip_ws()
+        end = decode() # read_more()로 buf가 잘리면 pos도 바뀌므로 decode 뒤의 pos를 쓴다
+        key = json.loads(buf[pos:end])
+        advance(end)
+        expect(':')
+        skip_ws()
+        start = byte_pos
+        advance(decode())
+        index[key] = (start, byte_pos - start)
+        if expect(',}') == '}':
+            return index
+
+
+def write_records(f, items):
+    '''
+        json.dump(data, f, indent='\t', ensure_ascii=False) 와 같은 형식으로 쓰고 key -> (byte offset, length) 인덱스를 리턴
+
+        args:
+            f : binary file
+            items : (key, value) 목록. value는 json 객체 또는 이미 직렬화된 bytes (원본 복사)
+    '''
+    index = {}
+    pos = f.write(b'{')
+    for i, (key, value) in enumerate(items):
+        if isinstance(value, bytes):
+            value = value.strip()
+        else:
+            value = json.dumps(value, indent='\t', ensure_ascii = False)
+            value = value.replace('\n', '\n\t').encode('utf-8')
+
+        head = (',' if i > 0 else '') + '\n\t' + json.dumps(key, ensure_ascii = False) + ': '
+        pos += f.write(head.encode('utf-8'))
+        index[key] = (pos, len(value))
+        pos += f.write(value)
+    f.write(b'\n}' if len(index) > 0 else b'}')
+    return index
+
+
+def _stat_key(stat):
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+def load_index(index_path, stat):
+    '''
+        sidecar가 stat (열어둔 master 파일)과 같은 파일에서 만들어졌으면 인덱스를, 아니면 None
+    '''
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        with open(index_path, 'r') as f:
+            cached = json.load(f)
+        if cached['stat'] == _stat_key(stat):
+            return {k: (off, length) for k, off, length in cached['index']}
+    except (ValueError, KeyError):
+        pass
+    return None
+
+def save_index(index_path, index, stat):
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            'stat' : _stat_key(stat),
+            'index' : [[k, off, length] for k, (off, length) in index.items()],
+        }, f, ensure_ascii = False)
+    os.replace(tmp_path, index_path)
+
+
+class LazyMasterJSON(MutableMapping):
+    '''
+        master json을 dict처럼 다루되, record는 접근할 때만 seek + json.loads 로 materialize 하는 reader
+
+        파일은 한 번 열어두고 인덱스와 모든 read를 그 handle 기준으로 한다. (다른 process가 교체해도 섞이지 않음)
+        key -> byte offset 인덱스는 '<json>.idx' sidecar에 캐시되며 (inode, size, mtime)이 바뀌면 다시 만든다.
+    '''
+    max_retries = 5
+
+    def __init__(self, json_path, use_cache=True):
+        self.json_path = json_path
+        self.index_path = json_path + '.idx'
+        self.use_cache = use_cache
+
+        self._records = {}    # materialize 된 record
+        self._deleted = set() # 아직 파일에 남아있는 삭제된 key
+        self._keys = []
+        self._f = None
+        self._stat = None
+        self._open()
+
+    def _open(self, f=None, index=None):
+        '''
+            json_path (또는 방금 쓴 파일 f)를 열고 인덱스를 맞춘다. 메모리의 record / 추가 / 삭제는 유지
+        '''
+        if f is None:
+            f = open(self.json_path, 'rb')
+        self.close()
+        self._f = f
+        self._stat = os.fstat(f.fileno())
+
+        if index is None:
+            index = self._load_index()
+        for key in self._deleted:
+            index.pop(key, None)
+        added = [key for key in self._keys if key not in index and key in self._records]
+        self._index = index
+        self._keys = list(index.keys()) + added
+
+    def _load_index(self):
+        if self.use_cache:
+            index = load_index(self.index_path, self._stat)
+            if index is not None:
+                return index
+
+        index = build_offset_index(self._f)
+        if self.use_cache:
+            save_index(self.index_path, index, self._stat)
+        return index
+
+    def _is_current(self):
+        '''
+            json_path가 아직 열어둔 파일을 가리키는지
+        '''
+        if self._f is None:
+            return False
+        try:
+            stat = os.stat(self.json_path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_dev, stat.st_ino, stat.st_mtime_ns) == (self._stat.st_dev, self._stat.st_ino, self._stat.st_mtime_ns)
+
+    def _read_raw(self, key):
+        if self._f is None:
+            self._open()
+        off, length = self._index[key]
+        self._f.seek(off)
+        return self._f.read(length)
+
+    def __getitem__(self, key):
+        if key not in self._records:
+            if key not in self._index:
+                raise KeyError(key)
+            self._records[key] = json.loads(self._read_raw(key))
+        return self._records[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._records and key not in self._index:
+            self._keys.append(key)
+        self._records[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._records and key not in self._index:
+            raise KeyError(key)
+        self._records.pop(key, None)
+        if self._index.pop(key, None) is not None:
+            self._deleted.add(key)
+        self._keys.remove(key)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._records or key in self._index
+
+    def fingerprint(self, key):
+        '''
+            파일에 저장된 record byte의 crc32 (json parsing 없이 변경 여부 비교용), 메모리에만 있는 record는 None
+        '''
+        if key in self._records or key not in self._index:
+            return None
+        return zlib.crc32(self._read_raw(key).strip())
+
+    def file_stat(self):
+        '''
+            열어둔 master 파일의 [size, mtime_ns]. 메모리의 record / 추가 / 삭제가 있으면 (파일과 다를 수 있으므로) None
+        '''
+        if len(self._records) > 0 or len(self._deleted) > 0 or len(self._keys) != len(self._index):
+            return None
+        return [self._stat.st_size, self._stat.st_mtime_ns]
+
+    def release(self, key):
+        '''
+            변경하지 않은 record를 메모리에서 내린다. (dump 시 원본 byte를 그대로 복사)
+        '''
+        if key in self._index:
+            self._records.pop(key, None)
+
+    def dump(self, json_path=None):
+        '''
+            materialize 된 record만 다시 직렬화하고 나머지는 원본 byte를 복사하여 저장
+
+            json_path가 읽던 파일과 같으면, 복사 전 / 교체 전에 다른 process가 파일을 바꿨는지 확인하고
+            바뀌었으면 새 파일을 다시 열어 (메모리의 record는 유지) 처음부터 다시 쓴다.
+        '''
+        if json_path is None:
+            json_path = self.json_path
+        same_file = os.path.abspath(json_path) == os.path.abspath(self.json_path)
+
+        for _ in range(self.max_retries):
+            if self._f is None or (same_file and not self._is_current()):
+                self._open()
+
+            tmp_path = '{}.{}.tmp'.format(json_path, os.getpid()) # 여러 process가 같은 master를 저장할 수 있음
+            with open(tmp_path, 'wb') as f:
+                index = write_records(f, (
+                    (key, self._records[key] if key in self._records else self._read_raw(key))
+                    for key in self._keys
+                ))
+                f.flush()
+                stat = os.fstat(f.fileno())
+
+            if same_file and not self._is_current():
+                os.remove(tmp_path)
+                continue
+
+            if not same_file:
+                os.replace(tmp_path, json_path)
+                if self.use_cache:
+                    save_index(json_path + '.idx', index, stat)
+                return
+
+            new_f = open(tmp_path, 'rb') # 교체 직후 다른 process가 또 바꿔도 방금 쓴 파일을 계속 읽도록
+            os.replace(tmp_path, json_path)
+            self._deleted.clear()
+            self._open(new_f, index)
+            if self.use_cache:
+                save_index(self.index_path, index, self._stat)
+            return
+
+        raise RuntimeError('{} kept changing while saving'.format(json_path))
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
@@ -0,0 +1,121 @@
+import os
+import json
+
+from lazy_json import LazyMasterJSON
+
+
+def get_unique_patient_id(key, record):
+    '''
+        record의 'patient_id', 없으면 json key의 prefix (A-2106161442_ecg_2021-06-16_18.csv -> A-2106161442)
+    '''
+    if record.get('patient_id') is not None:
+        return record['patient_id']
+    return key.split('_')[0]
+
+
+class PatientIndex:
+    '''
+        unique patient id -> master json key 목록 (recorded_time 순) 인덱스
+
+        '<json>.pid.json' sidecar에 저장된다. update()는 모든 key의 patient id / recorded_time을 비교하되,
+        lazy master는 record byte의 crc32 (fingerprint)가 같으면 parsing 없이 건너뛴다.
+        lazy master 파일의 (size, mtime)이 sidecar를 만들 때와 같으면 비교 자체를 건너뛴다.
+    '''
+    def __init__(self, json_path, index_path=None):
+        self.json_path = json_path
+        self.index_path = index_path
+        if self.index_path is None:
+            self.index_path = json_path + '.pid.json'
+
+        self.records = {}  # key -> [unique patient id, recorded_time, fingerprint]
+        self.master_stat = None # 마지막으로 비교한 lazy master 파일의 [size, mtime_ns]
+        self.patients = {} # unique patient id -> [key, ...] (recorded_time 순)
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                cached = json.load(f)
+            self.records = cached['records']
+            self.master_stat = cached.get('master')
+        except (ValueError, KeyError):
+            self.records = {}
+            self.master_stat = None
+        self._build_patients()
+
+    def _build_patients(self):
+        self.patients = {}
+        for key, (p_id, *_) in self.records.items():
+            self.patients.setdefault(p_id, []).append(key)
+        for keys in self.patients.values():
+            self._sort(keys)
+
+    def _sort(self, keys):
+        keys.sort(key=lambda k: self.records[k][1] or '')
+
+    def save(self):
+        tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'master' : self.master_stat, 'records' : self.records}, f, ensure_ascii = False)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _get_fields(key, record):
+        return [get_unique_patient_id(key, record), record.get('recorded_time')]
+
+    def add(self, key, record, fingerprint=None):
+        p_id, recorded_time = self._get_fields(key, record)
+        if key in self.records:
+            self.remove(key)
+
+        self.records[key] = [p_id, recorded_time, fingerprint]
+        keys = self.patients.setdefault(p_id, [])
+        keys.append(key)
+        self._sort(keys)
+
+    def remove(self, key):
+        p_id = self.records.pop(key)[0]
+        self.patients[p_id].remove(key)
+        if len(self.patients[p_id]) == 0:
+            del self.patients[p_id]
+
+    def update(self, patient_dict):
+        '''
+            master에 추가/삭제되었거나 patient id / recorded_time이 바뀐 key를 반영하고,
+            바뀐 것이 있으면 sidecar를 다시 저장
+        '''
+        is_lazy = isinstance(patient_dict, LazyMasterJSON)
+        master_stat = patient_dict.file_stat() if is_lazy else None
+        if master_stat is not None and master_stat == self.master_stat: # 마지막 비교 이후 바뀌지 않은 master
+            return self
+
+        changed = master_stat != self.master_stat
+        self.master_stat = master_stat
+        for key in patient_dict:
+            entry = self.records.get(key)
+            fingerprint = patient_dict.fingerprint(key) if is_lazy else None
+            if entry is not None and fingerprint is not None and entry[2:] == [fingerprint]:
+                continue
+
+            record = patient_dict[key]
+            if entry is None or entry[:2] != self._get_fields(key, record):
+                self.add(key, record, fingerprint)
+                changed = True
+            elif entry[2:] != [fingerprint]: # 다른 field만 바뀐 record
+                self.records[key] = entry[:2] + [fingerprint]
+                changed = True
+            if fingerprint is not None: # 여기서 읽은 record만 다시 내린다
+                patient_dict.release(key)
+
+        for key in [k for k in self.records if k not in patient_dict]:
+            self.remove(key)
+            changed = True
+
+        if changed:
+            self.save()
+        return self
+
+    def get(self, unique_id):
+        return list(self.patients.get(unique_id, []))
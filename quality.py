@@ -0,0 +1,194 @@
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+
+from utils import parse_json, update_master
+from waveform_store import WaveformStore
+
+
+QUALITY_KEY = 'quality'
+
+
+def _blocks(x, block):
+    '''
+        (num_chunks, L) -> (num_chunks, L // block, block) (남는 샘플은 버림)
+    '''
+    num_blocks = max(x.shape[1] // block, 1)
+    block = min(block, x.shape[1])
+    return x[:, : num_blocks * block].reshape(x.shape[0], num_blocks, block)
+
+
+def compute_chunk_quality(chunks, chunk_seconds=10.0):
+    '''
+        같은 길이의 chunk 묶음에 대한 signal quality 지표 (chunk 축으로 vectorize)
+
+        args:
+            chunks (np.ndarray) : (num_chunks, L) raw wave
+            chunk_seconds (float) : chunk 하나의 길이 (sampling rate 추정용)
+        return:
+            dict of (num_chunks,) np.ndarray
+                flatline  : 0.5s 구간 중 진폭이 거의 0인 구간 비율
+                clipping  : chunk 최대 / 최소값에 붙어있는 샘플 비율
+                wander    : 0.5s 평균 (baseline)의 표준편차 / baseline 제거 후 진폭
+                hf_energy : 2차 차분 에너지 / 전체 에너지
+    '''
+    x = np.asarray(chunks, dtype=np.float64)
+    num_chunks, length = x.shape
+    if length < 3:
+        zeros = np.zeros(num_chunks)
+        return dict(flatline=zeros + 1.0, clipping=zeros, wander=zeros, hf_energy=zeros)
+
+    block = max(int(length / chunk_seconds * 0.5), 1)
+    blocks = _blocks(x, block)
+    baseline = blocks.mean(axis=2)
+    detrended = blocks - baseline[..., None]
+
+    # max - min 대신 1% ~ 99% percentile 구간을 진폭으로 써서 spike 하나에 휘둘리지 않게 한다
+    p01, p99 = np.percentile(detrended.reshape(num_chunks, -1), [1, 99], axis=1)
+    amplitude = np.maximum(p99 - p01, 1e-6)
+
+    block_ptp = blocks.max(axis=2) - blocks.min(axis=2)
+    flatline = (block_ptp <= amplitude[:, None] * 0.01).mean(axis=1)
+
+    lo = x.min(axis=1, keepdims=True)
+    hi = x.max(axis=1, keepdims=True)
+    tol = np.maximum((hi - lo) * 1e-3, 1e-6)
+    clipping = ((x >= hi - tol) | (x <= lo + tol)).mean(axis=1)
+
+    wander = baseline.std(axis=1) / amplitude
+
+    centered = x - x.mean(axis=1, keepdims=True)
+    energy = np.maximum((centered ** 2).mean(axis=1), 1e-12)
+    hf_energy = (np.diff(x, n=2, axis=1) ** 2).mean(axis=1) / energy
+
+    return dict(flatline=flatline, clipping=clipping, wander=wander, hf_energy=hf_energy)
+
+
+class QualityScreen:
+    '''
+        master json의 모든 record를 3개 chunk로 나눠 signal quality 지표를 계산하고
+        record['quality'] = [ {지표..., 'artifact' : bool}, x3 ] 로 저장하는 기능
+
+        길이가 같은 chunk끼리 batch_size 개씩 묶어 한 번에 계산한다.
+        ECG_GUI는 이 값으로 'artifact' 를 미리 제안하고 깨끗한 record부터 보여준다.
+    '''
+    # 지표 별 artifact 판정 기준 (이 값을 넘으면 artifact 제안)
+    thresholds = {
+        'flatline' : 0.5,
+        'clipping' : 0.05,
+        'wander' : 0.5,
+        'hf_energy' : 1.0,
+    }
+    num_chunks = 3
+
+    def __init__(self, **kwargs):
+        self.json_path = kwargs.get('master_json')
+        self.lazy_json = kwargs.get('lazy_json', False)
+
+        wave_dir = kwargs.get('wave_dir')
+        if wave_dir is None:
+            wave_dir = WaveformStore.default_dir(self.json_path)
+        self.wave_store = WaveformStore(wave_dir)
+
+        self.batch_size = kwargs.get('batch_size')
+        if self.batch_size is None:
+            self.batch_size = 256
+        self.chunk_seconds = kwargs.get('chunk_seconds')
+        if self.chunk_seconds is None:
+            self.chunk_seconds = 10.0
+        self.force = kwargs.get('force', False)
+
+    @classmethod
+    def to_entries(cls, metrics):
+        entries = []
+        for i in range(len(metrics['flatline'])):
+            entry = {name : round(float(value[i]), 4) for name, value in metrics.items()}
+            entry['artifact'] = any(entry[name] > th for name, th in cls.thresholds.items())
+            entries.append(entry)
+        return entries
+
+    def _flush(self, qualities, batch):
+        '''
+            qualities : key -> chunk 별 quality list
+            batch : [(key, time_step, chunk), ...] (chunk 길이 동일)
+        '''
+        metrics = compute_chunk_quality(np.stack([chunk for _, _, chunk in batch]), self.chunk_seconds)
+        for (key, time_step, _), entry in zip(batch, self.to_entries(metrics)):
+            qualities[key][time_step-1] = entry
+
+    def __call__(self):
+        patient_dict, _ = parse_json(self.json_path, lazy=self.lazy_json)
+
+        batches = {} # chunk 길이 -> [(key, time_step, chunk), ...]
+        qualities = {}
+        cnt = 0
+        for key in tqdm(list(patient_dict.keys())):
+            record = patient_dict[key]
+            if not self.force and record.get(QUALITY_KEY) is not None:
+                continue
+
+            qualities[key] = [None] * self.num_chunks
+            for time_step in range(1, self.num_chunks + 1):
+                chunk = self.wave_store.get_chunk(record, 'raw_ecg_wave_voltage', time_step, self.num_chunks)
+                batch = batches.setdefault(len(chunk), [])
+                batch.append((key, time_step, np.asarray(chunk)))
+                if len(batch) >= self.batch_size:
+                    self._flush(qualities, batch)
+                    batch.clear()
+            cnt += 1
+
+        for batch in batches.values():
+            if len(batch) > 0:
+                self._flush(qualities, batch)
+
+        # quality field만 lock을 잡고 반영 (그 사이 ECG_GUI가 저장한 annotation을 덮어쓰지 않도록)
+        update_master(self.json_path, {key : {QUALITY_KEY : quality} for key, quality in qualities.items()})
+        print('{} records screened'.format(cnt))
+
+
+def suggest_artifact(record, time_step):
+    quality = record.get(QUALITY_KEY)
+    if not quality or quality[time_step-1] is None:
+        return False
+    return quality[time_step-1]['artifact']
+
+def get_quality_score(record):
+    '''
+        record에서 가장 나쁜 chunk의 (지표 / 기준) 최대값. 작을수록 깨끗함, 지표가 없으면 0
+    '''
+    quality = record.get(QUALITY_KEY)
+    if not quality:
+        return 0.0
+    score = 0.0
+    for entry in quality:
+        if entry is None:
+            continue
+        for name, th in QualityScreen.thresholds.items():
+            score = max(score, entry[name] / th)
+    return score
+
+
+def opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--master_json', type=str, default='./sample2.json')  # master json 파일 경로
+    parser.add_argument('--wave_dir', type=str, default=None)                # binary wave 저장 경로 (default: <master_json>_wave)
+    parser.add_argument('--lazy_json', action='store_true')                  # master json record를 필요할 때만 읽음
+    parser.add_argument('--batch_size', type=int, default=256)               # 한 번에 계산할 chunk 수
+    parser.add_argument('--force', action='store_true')                      # 이미 계산된 record도 다시 계산
+    return parser.parse_args()
+
+def main():
+    args = opt()
+
+    QualityScreen(
+        master_json = args.master_json,
+        wave_dir = args.wave_dir,
+        lazy_json = args.lazy_json,
+        batch_size = args.batch_size,
+        force = args.force,
+    )()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
 import os
+import re
 import json
+import hashlib
 import argparse
 import cv2
 
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np 
 from tqdm import tqdm
 import matplotlib.pyplot as plt
@@ -10,17 +14,58 @@ import matplotlib
 #matplotlib.use("MacOSX")
 matplotlib.use('agg')
 
-from utils import parse_json
+import instrument
+from utils import parse_json, update_master, minmax_decimate
+from waveform_store import WaveformStore
 
 
 class ECGDrawer:
     '''
         plt로 ecg wave 그리고 np.ndarray로 변환하여 리턴하는 기능
+
+        reuse_figure=True 이면 figure / axes / line / legend를 한 번만 만들고
+        이후 호출에서는 data와 label만 바꿔서 다시 그린다. (출력은 매번 새로 만드는 경우와 동일)
     '''
-    def __init__(self, figsize=(10,1.5), tight_layout=True):
+    def __init__(self, figsize=(10,1.5), tight_layout=True, reuse_figure=False):
         self.figsize = figsize
         self.tight_layout = tight_layout
+        self.reuse_figure = reuse_figure
+
+        self._fig = None
+        self._line = None
+        self._legend = None
 
+    def _canvas_to_array(self, fig):
+        fig.canvas.draw()
+        fig_arr = np.array( fig.canvas.renderer._renderer )
+        fig_arr = fig_arr.reshape( fig.canvas.get_width_height()[::-1] + (4,) )
+        return fig_arr
+
+    def _draw_reused(self, data, label, linewidth, color):
+        if self._fig is None:
+            self._fig = plt.figure(figsize=self.figsize, tight_layout=self.tight_layout)
+            self._line, = plt.plot(data, color=color, label=label, linewidth=linewidth)
+            self._legend = plt.legend(loc='upper right')
+            plt.axis('off')
+        else:
+            if color is None: # 새 figure의 첫 번째 line 색상
+                color = 'C0'
+            ax = self._line.axes
+            self._line.set_data(np.arange(len(data)), data)
+            self._line.set_label(label)
+            self._line.set_color(color)
+            self._line.set_linewidth(linewidth)
+            ax.relim()
+            ax.autoscale_view()
+
+            self._legend.get_texts()[0].set_text(label)
+            legend_handle = self._legend.get_lines()[0]
+            legend_handle.set_color(color)
+            legend_handle.set_linewidth(linewidth)
+
+        return self._canvas_to_array(self._fig)
+
+    @instrument.span('render.draw')
     def __call__(self, LR_value, data, label, linewidth, color):
         '''
             LR 값, ecg np.ndarray, 레이블 정보
@@ -28,32 +73,181 @@ class ECGDrawer:
         if isinstance(data, list):
             data = np.array(data)
 
-        fig = plt.figure(figsize=self.figsize, tight_layout=self.tight_layout)
-
         # ecg plot
         if linewidth is None:
             linewidth = 0.5
+
+        if self.reuse_figure:
+            return self._draw_reused(data, label, linewidth, color)
+
+        fig = plt.figure(figsize=self.figsize, tight_layout=self.tight_layout)
+
         plt.plot(data, color=color, label=label, linewidth=linewidth)
         
         plt.legend(loc='upper right')
         plt.axis('off')
-        fig.canvas.draw()
-        fig_arr = np.array( fig.canvas.renderer._renderer )
-        fig_arr = fig_arr.reshape( fig.canvas.get_width_height()[::-1] + (4,) )
+        fig_arr = self._canvas_to_array(fig)
 
         plt.close(fig)
 
         return fig_arr
 
+class ECGRasterDrawer:
+    '''
+        matplotlib 없이 ecg wave를 np.ndarray 이미지 버퍼에 직접 rasterize 하는 기능 (ECGDrawer와 같은 인터페이스)
+
+        - 출력 : ECGDrawer와 같은 크기 / 채널 순서 (RGBA)의 np.ndarray
+        - pixel column 당 샘플이 2개를 넘으면 column 별 min/max로 decimation 후 anti-aliased polyline
+    '''
+    dpi = 100
+    axes_box = (0.015, 0.1, 0.97, 0.8) # tight_layout + axis('off') 일 때 axes 위치 (left, bottom, width, height)
+    margin = 0.05                      # matplotlib autoscale margin
+    shift = 4                          # cv2 sub-pixel 좌표 bit 수
+
+    def __init__(self, figsize=(10,1.5), tight_layout=True):
+        self.figsize = figsize
+        self.tight_layout = tight_layout
+
+        self.width = int(round(figsize[0] * self.dpi))
+        self.height = int(round(figsize[1] * self.dpi))
+
+        left, bottom, w, h = self.axes_box
+        self.x0 = left * self.width
+        self.y0 = (1.0 - bottom - h) * self.height
+        self.plot_w = w * self.width
+        self.plot_h = h * self.height
+
+    @staticmethod
+    def _to_rgba(color):
+        if color is None:
+            color = 'C0'
+        r, g, b, a = matplotlib.colors.to_rgba(color)
+        return (int(r*255), int(g*255), int(b*255), int(a*255))
+
+    def _draw_legend(self, img, label, color, thickness):
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        scale = 0.5
+        (text_w, text_h), baseline = cv2.getTextSize(label, font, scale, 1)
+
+        handle_w = 28
+        pad = 6
+        box_w = pad + handle_w + pad + text_w + pad
+        box_h = pad + text_h + baseline + pad
+
+        x1 = int(self.x0 + self.plot_w) - 4
+        y0 = int(self.y0) + 4
+        x0 = x1 - box_w
+        y1 = y0 + box_h
+
+        cv2.rectangle(img, (x0, y0), (x1, y1), (255,255,255,255), -1)
+        cv2.rectangle(img, (x0, y0), (x1, y1), (204,204,204,255), 1, cv2.LINE_AA)
+
+        y_mid = y0 + box_h // 2
+        cv2.line(img, (x0 + pad, y_mid), (x0 + pad + handle_w, y_mid), color, thickness, cv2.LINE_AA)
+        cv2.putText(img, label, (x0 + 2*pad + handle_w, y_mid + text_h // 2),
+                    font, scale, (0,0,0,255), 1, cv2.LINE_AA)
+
+    def _draw(self, x, y, x_range, y_range, label, linewidth, color):
+        '''
+            data 좌표 (x, y) polyline을 x_range / y_range가 axes를 채우도록 그린다.
+        '''
+        if linewidth is None:
+            linewidth = 0.5
+        thickness = max(1, int(round(linewidth * self.dpi / 72.0)))
+        color = self._to_rgba(color)
+
+        img = np.full((self.height, self.width, 4), 255, dtype=np.uint8)
+        if len(x) == 0:
+            return img
+
+        x_lo, x_hi = x_range
+        y_lo, y_hi = y_range
+        px = self.x0 + (x - x_lo) / (x_hi - x_lo) * self.plot_w
+        py = self.y0 + (y_hi - y) / (y_hi - y_lo) * self.plot_h
+        pts = np.round(np.stack([px, py], axis=1) * (1 << self.shift)).astype(np.int32)
+
+        cv2.polylines(img, [pts], False, color, thickness, cv2.LINE_AA, self.shift)
+
+        if label is not None:
+            self._draw_legend(img, label, color, thickness)
+
+        return img
+
+    def _y_range(self, y_min, y_max):
+        y_span = y_max - y_min
+        if y_span == 0:
+            y_span = 1.0
+        return y_min - self.margin * y_span, y_max + self.margin * y_span
+
+    @instrument.span('render.draw_raster')
+    def __call__(self, LR_value, data, label, linewidth, color):
+        '''
+            LR 값, ecg np.ndarray, 레이블 정보
+        '''
+        data = np.asarray(data, dtype=np.float64)
+        if len(data) == 0:
+            return self._draw(data, data, None, None, None, linewidth, color)
+
+        x, y = minmax_decimate(data, self.plot_w)
+
+        # data 좌표 -> pixel 좌표 (matplotlib과 같은 5% margin)
+        x_span = max(len(data) - 1, 1)
+        x_range = (-self.margin * x_span, (1 + self.margin) * x_span)
+        y_range = self._y_range(float(data.min()), float(data.max()))
+
+        return self._draw(x, y, x_range, y_range, label, linewidth, color)
+
+    def draw_envelope(self, x, lo, hi, x_range, label, linewidth, color):
+        '''
+            zoom / pan 화면 : 칸 별 (min, max) envelope (WaveformStore.get_envelope 결과)를 그린다.
+
+            args:
+                x_range (tuple) : 화면 왼쪽 / 오른쪽 끝의 샘플 위치 (margin 없음)
+        '''
+        if len(x) == 0:
+            return self._draw(x, x, None, None, None, linewidth, color)
+
+        # 칸마다 min -> max, 다음 칸은 max -> min 순서로 이어 그린다
+        y = np.empty(len(x) * 2, dtype=np.float64)
+        y[0::4], y[1::4] = lo[0::2], hi[0::2]
+        y[2::4], y[3::4] = hi[1::2], lo[1::2]
+        y_range = self._y_range(float(lo.min()), float(hi.max()))
+
+        return self._draw(np.repeat(x, 2), y, x_range, y_range, label, linewidth, color)
+
+# RenderFigure(drawer=...) 로 선택
+ECG_DRAWERS = {
+    'matplotlib' : ECGDrawer,
+    'raster' : ECGRasterDrawer,
+}
+
 class RenderFigure:
+    RENDER_VERSION = 1 # 그리는 방식이 바뀌면 올려서 render cache 전체를 무효화
+
     def __init__(self, json, render_dir, **kwargs):
         self.json_path = json
         self.render_dir = render_dir
         os.makedirs(self.render_dir, exist_ok=True)
 
-        self.patient_dict, self.patient_idx_list = parse_json(self.json_path)
+        if kwargs.get('patient_dict') is not None: # 이미 읽은 master (worker process 등)
+            self.patient_dict = kwargs.get('patient_dict')
+            self.patient_idx_list = list(range(len(self.patient_dict.keys())))
+        else:
+            self.patient_dict, self.patient_idx_list = parse_json(self.json_path, lazy=kwargs.get('lazy_json', False))
 
-        self.ecg_visualizer = ECGDrawer(figsize=(10,1.5))
+        self.drawer = kwargs.get('drawer')
+        if self.drawer is None:
+            self.drawer = 'matplotlib'
+        if self.drawer not in ECG_DRAWERS:
+            raise ValueError('drawer must be one of {}, but got {}'.format(list(ECG_DRAWERS), self.drawer))
+        self.figsize = kwargs.get('figsize')
+        if self.figsize is None:
+            self.figsize = (10,1.5)
+        self.reuse_figure = kwargs.get('reuse_figure', False)
+        if self.drawer == 'matplotlib':
+            self.ecg_visualizer = ECGDrawer(figsize=self.figsize, reuse_figure=self.reuse_figure)
+        else:
+            self.ecg_visualizer = ECG_DRAWERS[self.drawer](figsize=self.figsize)
 
         self.idx_to_id = {}
         for patient_id, idx in zip(self.patient_dict.keys(), self.patient_idx_list):
@@ -63,18 +257,55 @@ class RenderFigure:
         if self.force_render is None:
             self.force_render = False
 
+        self.lazy_json = kwargs.get('lazy_json', False)
+        self.num_workers = kwargs.get('num_workers')
+        if self.num_workers is None:
+            self.num_workers = 1
         self.fig_line_width = kwargs.get('fig_line_width')
         self.color = kwargs.get('line_color')
 
-    def draw_ecg_wave(self, patient_id, time_step):
-        LR_value = self.patient_dict[patient_id]['LR']
-        raw_data = self.patient_dict[patient_id]['raw_ecg_wave_voltage']
-        denoised_data = self.patient_dict[patient_id]['denoised_ecg_wave_voltage']
+        # 참조되지 않는 렌더링 이미지 삭제 여부
+        self.gc_render = kwargs.get('gc_render')
+        if self.gc_render is None:
+            self.gc_render = True
+
+        # render cache key에 들어가는 그리기 파라미터
+        self.render_params = dict(
+            version = self.RENDER_VERSION,
+            drawer = self.drawer,
+            figsize = list(self.figsize),
+            fig_line_width = self.fig_line_width,
+            line_color = self.color,
+        )
+
+        # binary waveform store (json에 voltage list가 없는 record용)
+        wave_dir = kwargs.get('wave_dir')
+        if wave_dir is None:
+            wave_dir = WaveformStore.default_dir(self.json_path)
+        self.wave_store = WaveformStore(wave_dir)
+
+        # worker process에서 같은 설정의 RenderFigure를 다시 만들기 위한 인자
+        self.worker_kwargs = dict(
+            json = self.json_path,
+            render_dir = self.render_dir,
+            wave_dir = wave_dir,
+            fig_line_width = self.fig_line_width,
+            line_color = self.color,
+            drawer = self.drawer,
+            figsize = self.figsize,
+            reuse_figure = self.reuse_figure,
+        )
+
+    def _get_chunks(self, record, time_step):
+        raw_data2 = self.wave_store.get_chunk(record, 'raw_ecg_wave_voltage', time_step)
+        denoised_data2 = self.wave_store.get_chunk(record, 'denoised_ecg_wave_voltage', time_step)
+        return raw_data2, denoised_data2
 
-        chunk_size = len(raw_data) // 3
-        offset = (time_step-1) * chunk_size
-        raw_data2 = raw_data[ offset : offset + chunk_size ]
-        denoised_data2 = denoised_data[ offset : offset + chunk_size ]
+    def draw_ecg_wave(self, patient_id, time_step, record=None):
+        if record is None:
+            record = self.patient_dict[patient_id]
+        LR_value = record['LR']
+        raw_data2, denoised_data2 = self._get_chunks(record, time_step)
 
         # LR, data, label          0 1 2 
         raw = self.ecg_visualizer( 
@@ -99,34 +330,152 @@ class RenderFigure:
         img = cv2.line(img, pt1, pt2, color)
         return img
 
+    def get_render_name(self, p_id, record, time_step):
+        '''
+            waveform 샘플 + 그리기 파라미터의 hash로 이미지 파일 이름을 만든다. (content-addressed)
+            파라미터나 데이터가 바뀌면 이름이 바뀌므로 기존 파일은 재사용되지 않는다.
+        '''
+        h = hashlib.sha1()
+        h.update(json.dumps(self.render_params, sort_keys=True).encode('utf-8'))
+        h.update(str(time_step).encode('utf-8'))
+        for data in self._get_chunks(record, time_step):
+            h.update(np.ascontiguousarray(data, dtype=np.float64).tobytes())
+
+        return '{}-{}-{}.png'.format(p_id, time_step, h.hexdigest()[:16])
+
+    def _get_stale_steps(self, record, img_name):
+        '''
+            다시 그려야 하는 (time_step, file name) 목록
+        '''
+        if self.force_render:
+            return list(zip(range(1, 4), img_name))
+
+        prev_img_name = record.get('img_name') or []
+        ret = []
+        for time_step, file_name in zip(range(1, 4), img_name):
+            if time_step <= len(prev_img_name) and prev_img_name[time_step-1] == file_name:
+                if os.path.isfile(os.path.join(self.render_dir, file_name)):
+                    continue
+            ret.append((time_step, file_name))
+        return ret
+
+    def render_patient(self, p_id, record, targets=None):
+        '''
+            record 하나의 time step 이미지를 render_dir에 쓰고 파일 이름 목록을 리턴
+
+            args:
+                targets (list) : 그릴 (time_step, file name) 목록. None이면 3개 모두
+        '''
+        if targets is None:
+            targets = [(t, self.get_render_name(p_id, record, t)) for t in range(1, 4)]
+
+        img_name = []
+        for time_step, file_name in targets:
+            img = self.draw_ecg_wave(p_id, time_step, record=record)
+            # write file
+            with instrument.span('render.imwrite'):
+                cv2.imwrite(os.path.join(self.render_dir, file_name), img)
+            img_name.append(file_name)
+        return img_name
+
+    def _collect_garbage(self, referenced):
+        '''
+            이 master의 key로 만든 렌더링 이미지 중 더 이상 참조되지 않는 것 (이전 hash)을 지운다.
+            render_dir을 다른 master와 같이 쓰는 경우가 있으므로 다른 key의 이미지는 건드리지 않는다.
+        '''
+        removed = 0
+        for file_name in os.listdir(self.render_dir):
+            if file_name in referenced:
+                continue
+            m = _RENDER_NAME.match(file_name)
+            if m is None or m.group('key') not in self.patient_dict:
+                continue
+            os.remove(os.path.join(self.render_dir, file_name))
+            removed += 1
+        return removed
+
     def __call__(self):
         pbar = tqdm(total=len(self.patient_dict.keys()))
+        num_hit, num_miss = 0, 0
+        referenced = set()
+        pending = [] # parallel 모드에서 worker로 보낼 (p_id, img_name, stale steps)
+        changes = {} # master에 반영할 p_id -> {'img_name' : ...}
+
         for i, p_id in enumerate(self.patient_dict):
-            if not self.force_render:
-                if 'img_name' in self.patient_dict[p_id]:
-                    if len(self.patient_dict[p_id]['img_name']) > 0:
-                        continue
-            
-            self.patient_dict[p_id]['img_name'] = []
-            for time_step in range(1, 4):
-                img = self.draw_ecg_wave(p_id, time_step)
-                # iamge path
-                file_name = str(p_id) + '-' + str(time_step) + '.png'
-                # write file
-                cv2.imwrite(os.path.join(self.render_dir, file_name), img)
+            record = self.patient_dict[p_id]
+            img_name = [self.get_render_name(p_id, record, t) for t in range(1, 4)]
+            stale = self._get_stale_steps(record, img_name)
+
+            referenced.update(img_name)
+            num_hit += len(img_name) - len(stale)
+            num_miss += len(stale)
+
+            if len(stale) == 0:
+                if self.lazy_json: # 변경이 없는 record는 메모리에 남기지 않음
+                    self.patient_dict.release(p_id)
+                pbar.update()
+                continue
+
+            if self.num_workers <= 1:
+                self.render_patient(p_id, record, stale)
                 # apply to json
-                self.patient_dict[p_id]['img_name'].append(file_name)
-                
-            pbar.update()
+                record['img_name'] = img_name
+                changes[p_id] = {'img_name' : img_name}
+                pbar.update()
+            else:
+                pending.append((p_id, img_name, stale))
+
+        if len(pending) > 0:
+            tasks = ((p_id, self.patient_dict[p_id], stale) for p_id, _, stale in pending)
+            with ProcessPoolExecutor(
+                max_workers = self.num_workers,
+                initializer = _init_render_worker,
+                initargs = (self.worker_kwargs,)
+            ) as executor:
+                # map은 입력 순서대로 결과를 돌려주므로 json 반영 순서가 항상 같다
+                for (p_id, img_name, _), _ in zip(pending, executor.map(_render_worker, tasks, chunksize=4)):
+                    self.patient_dict[p_id]['img_name'] = img_name
+                    changes[p_id] = {'img_name' : img_name}
+                    pbar.update()
+        pbar.close()
+
+        num_removed = 0
+        if self.gc_render:
+            num_removed = self._collect_garbage(referenced)
+        print('render cache : {} hit / {} miss / {} orphaned images removed'.format(num_hit, num_miss, num_removed))
+        instrument.count('render.cache_hit', num_hit)
+        instrument.count('render.cache_miss', num_miss)
+
+        if len(changes) > 0: # img_name이 바뀐 record만 lock을 잡고 디스크의 master에 반영 (다른 ECG_GUI의 저장을 덮어쓰지 않음)
+            update_master(self.json_path, changes)
+
+
+# RenderFigure가 만든 이미지 이름 (<key>-<time step>.png, <key>-<time step>-<hash>.png)
+_RENDER_NAME = re.compile(r'^(?P<key>.+)-[1-3](-[0-9a-f]{16})?\.png$')
+
+# worker process 당 하나씩 생성
+_worker_renderer = None
+
+def _init_render_worker(kwargs):
+    global _worker_renderer
+    _worker_renderer = RenderFigure(patient_dict={}, **kwargs)
 
-        with open(self.json_path, 'w') as f:
-            json.dump(self.patient_dict, f, indent='\t', ensure_ascii = False)
+def _render_worker(task):
+    p_id, record, targets = task
+    return _worker_renderer.render_patient(p_id, record, targets)
 
 
 def opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--master_json', type=str, default='./sample2.json')  # 입력 master json파일 경로 
     parser.add_argument('--render_dir', type=str, default='./render_vis')       # 렌더링 결과가 저장될 경로
+    parser.add_argument('--wave_dir', type=str, default=None)                  # binary wave 저장 경로 (default: <master_json>_wave)
+    parser.add_argument('--lazy_json', action='store_true')                    # master json record를 필요할 때만 읽음
+    parser.add_argument('--num_workers', type=int, default=1)                  # 렌더링 process 수
+    parser.add_argument('--force_render', action='store_true')                 # render cache를 무시하고 전체 다시 생성
+    parser.add_argument('--no_gc', action='store_true')                        # 참조되지 않는 렌더링 이미지를 지우지 않음
+    parser.add_argument('--reuse_figure', action='store_true')                 # matplotlib figure를 strip마다 새로 만들지 않고 재사용
+    parser.add_argument('--drawer', type=str, default='matplotlib', choices=list(ECG_DRAWERS)) # ecg wave 그리는 backend
     return parser.parse_args()
 
 def main():
@@ -135,7 +484,13 @@ def main():
     RenderFigure(
         json = args.master_json,
         render_dir = args.render_dir,
-        force_render = True, #! force render
+        wave_dir = args.wave_dir,
+        lazy_json = args.lazy_json,
+        num_workers = args.num_workers,
+        drawer = args.drawer,
+        reuse_figure = args.reuse_figure,
+        force_render = args.force_render, #! force render
+        gc_render = not args.no_gc,
         fig_line_width = 2.0, #! matplotlib fig line 두께 파라미터
         line_color = '#e35f62'
     )()
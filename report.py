@@ -1,19 +1,43 @@
 from abc import ABC, abstractmethod
 import argparse
 import os
+import io
+import json
+import time
 
-from PyPDF2 import PdfFileWriter, PdfFileReader, PdfFileMerger
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from PyPDF2 import PdfFileWriter, PdfFileReader
 
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.lib.units import inch
+from reportlab.lib import colors
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
-from utils import parse_json, parse_csv, get_attribute_from_dataframe
+import instrument
+from utils import parse_json, write_json, update_master, get_attribute_from_dataframe, minmax_decimate
+from utils import TechnicianIndex
 from utils import PatientSpecificAttribute, CommonAttribute
+from patient_index import PatientIndex
+from sqlite_store import SQLiteMasterStore
+from waveform_store import WaveformStore
 
 pdfmetrics.registerFont(TTFont("NanumGothicLight", "NanumGothicLight.ttf"))
 
+# cover pdf path -> 읽어둔 page 목록 (process 당 한 번만 parsing)
+_cover_pages = {}
+
+def load_cover_pages(cover_pdf):
+    if cover_pdf not in _cover_pages:
+        with open(cover_pdf, 'rb') as f:
+            reader = PdfFileReader(io.BytesIO(f.read()))
+        _cover_pages[cover_pdf] = [reader.getPage(i) for i in range(reader.getNumPages())]
+    return _cover_pages[cover_pdf]
+
 class BasePDF(ABC):
     @abstractmethod
     def drawText():
@@ -84,8 +108,95 @@ class PDF(BasePDF): # reportlab 의존성
             location = PDF.get_coords_by_ratio(location)
         pdf.drawImage(image_path, location[0], location[1], width=size[0], height=size[1])
 
+    @staticmethod
+    def drawWave(pdf, waves, location, size, labels=None, color=None, linewidth=0.5):
+        '''
+            ecg wave를 이미지 대신 vector path로 그린다. (strip box 안으로 clipping)
+
+            args:
+                waves (list) : 위에서부터 차례로 그릴 1d wave 목록 (box를 세로로 등분)
+                location (tuple or list) : box 좌하단 (ratio)
+                size (tuple or list) : box 크기 (width, height)
+                labels (list) : wave 별 범례 문자열
+        '''
+        if True: # TODO : make it optional
+            location = PDF.get_coords_by_ratio(location)
+        if color is None:
+            color = '#1f77b4'
+
+        x, y = location
+        width, height = size
+        row_h = height / len(waves)
+        margin = 0.05 # RenderFigure와 같은 autoscale margin
+
+        pdf.saveState()
+        clip = pdf.beginPath()
+        clip.rect(x, y, width, height)
+        pdf.clipPath(clip, stroke=0, fill=0)
+
+        pdf.setFillColor(colors.white)
+        pdf.rect(x, y, width, height, stroke=0, fill=1)
+
+        pdf.setStrokeColor(colors.toColor(color))
+        pdf.setLineWidth(linewidth)
+        pdf.setLineJoin(1)
+        for i, data in enumerate(waves):
+            data = np.asarray(data, dtype=np.float64)
+            if len(data) == 0:
+                continue
+            # axes box : 좌우 1.5%, 상하 10% (RenderFigure 이미지와 같은 배치)
+            box_x, box_w = x + 0.015*width, 0.97*width
+            box_y, box_h = y + height - (i+1)*row_h + 0.1*row_h, 0.8*row_h
+
+            idx, values = minmax_decimate(data, box_w)
+            x_span = max(len(data) - 1, 1)
+            y_min, y_max = float(data.min()), float(data.max())
+            y_span = (y_max - y_min) or 1.0
+
+            px = box_x + (idx + margin*x_span) / ((1 + 2*margin) * x_span) * box_w
+            py = box_y + (values - y_min + margin*y_span) / ((1 + 2*margin) * y_span) * box_h
+
+            path = pdf.beginPath()
+            path.moveTo(px[0], py[0])
+            for px_i, py_i in zip(px[1:].tolist(), py[1:].tolist()):
+                path.lineTo(px_i, py_i)
+            pdf.drawPath(path, stroke=1, fill=0)
+
+            if labels is not None:
+                pdf.setFont('NanumGothicLight', 6)
+                pdf.setFillColor(colors.black)
+                pdf.drawRightString(box_x + box_w - 2, box_y + box_h - 6, labels[i])
+
+        # raw / denoised 경계선
+        pdf.setStrokeColor(colors.black)
+        pdf.setLineWidth(0.3)
+        for i in range(1, len(waves)):
+            pdf.line(x, y + i*row_h, x + width, y + i*row_h)
+
+        pdf.restoreState()
+
+    @staticmethod
+    def beginForm(pdf, name):
+        pdf.beginForm(name)
+
+    @staticmethod
+    def endForm(pdf):
+        pdf.endForm()
+
+    @staticmethod
+    def doForm(pdf, name):
+        pdf.doForm(name)
+
+    @staticmethod
+    def hasForm(pdf, name):
+        return pdf.hasForm(name)
+
     @staticmethod
     def makePDF(pdf_path):
+        '''
+            args:
+                pdf_path (str or file-like) : 저장할 경로 또는 buffer
+        '''
         return Canvas(pdf_path)
 
     @staticmethod
@@ -99,17 +210,38 @@ class PDF(BasePDF): # reportlab 의존성
         return (target_x, target_y)
 
 
+def needs_report(record):
+    '''
+        annotation이 끝났는데 출력된 적이 없거나, 출력 이후 annotation이 바뀐 record
+    '''
+    if not record.get('is_annotated'):
+        return False
+    return not record.get('is_printed') or record.get('printed_annotation_time') != record.get('annotation_time')
+
+
 class ECGReport:
     def __init__(self, **kwargs):
         self._build_common(**kwargs)
         
         self.json_path = kwargs.get('master_json')
-        self.patient_master_dict, _ = parse_json(self.json_path)
-        self.technician_df = parse_csv(kwargs.get('technician_csv'))
+        self.lazy_json = kwargs.get('lazy_json', False)
+        self.patient_master_dict, _ = parse_json(self.json_path, lazy=self.lazy_json)
+        # sqlite master는 patient_id index column으로 바로 조회
+        self.patient_index = None
+        if not isinstance(self.patient_master_dict, SQLiteMasterStore):
+            self.patient_index = PatientIndex(self.json_path).update(self.patient_master_dict)
+
+        wave_dir = kwargs.get('wave_dir')
+        if wave_dir is None:
+            wave_dir = WaveformStore.default_dir(self.json_path)
+        self.wave_store = WaveformStore(wave_dir)
+        self.technician_index = TechnicianIndex(kwargs.get('technician_csv'))
+        self.last_print_state = None
         os.makedirs(self.pdf_root, exist_ok=True)
         
     def _build_common(self, **kwargs):
-        self.common_attribute = CommonAttribute(**kwargs.get('meta'))
+        self.meta = kwargs.get('meta')
+        self.common_attribute = CommonAttribute(**self.meta)
 
         self.cover_page = kwargs.get('meta')['cover_page']
         self.cover_pdf  = kwargs.get('meta')['cover']
@@ -118,31 +250,48 @@ class ECGReport:
         self.pdf_root = kwargs.get('pdf_root')
         self.method = kwargs.get('pdf_method')
 
+        # True이면 렌더링 png 대신 waveform에서 바로 vector path를 그린다 (render_dir 불필요)
+        self.vector_wave = kwargs.get('vector_wave', False)
+        self.line_color = kwargs.get('line_color')
+
 
     def _get_patient_attribute(self, json_key, attribute_type):
         return self.patient_master_dict[json_key][attribute_type]
     
-    def _get_patient_keys(self, unique_id):
-        ret = []
-        for k, v in self.patient_master_dict.items():
-            try:
-                if unique_id == v['patient_id']:
-                    ret.append(k)
-            except KeyError:
-                if unique_id in k:
-                    ret.append(k)
+    def _get_patient_waves(self, json_key):
+        record = self.patient_master_dict[json_key]
+        return [
+            (
+                self.wave_store.get_chunk(record, 'raw_ecg_wave_voltage', time_step),
+                self.wave_store.get_chunk(record, 'denoised_ecg_wave_voltage', time_step)
+            )
+            for time_step in range(1, 4)
+        ]
 
-        return ret
+    def _get_patient_keys(self, unique_id):
+        # recorded_time 순으로 정렬된 key 목록
+        if self.patient_index is None:
+            return self.patient_master_dict.patient_keys(unique_id)
+        return self.patient_index.get(unique_id)
 
     def _make_pdf(self, unique_p_id, p_name):
         pdf_path = os.path.join(self.pdf_root, str(p_name) + str(unique_p_id))
         pdf_path += '.pdf'
-        pdf = self.method.makePDF(pdf_path)
-        return pdf, pdf_path
+        # 본문은 메모리에 만들고 cover와 합쳐서 pdf_path에 한 번만 쓴다
+        contents = io.BytesIO()
+        pdf = self.method.makePDF(contents)
+        return pdf, contents, pdf_path
 
     def write_json(self):
-        with open(self.json_path, 'w') as f:
-            json.dump(self.patient_master_dict, f, indent='\t', ensure_ascii = False)
+        write_json(self.json_path, self.patient_master_dict)
+
+    def save_print_state(self, print_state):
+        '''
+            print 상태만 lock을 잡고 디스크의 master에 반영 (report 시작 시점의 master 전체를 다시 쓰지 않으므로
+            그 사이 ECG_GUI가 저장한 annotation이 유지되고, 바뀐 annotation은 다음 incremental 실행에서 다시 출력된다)
+        '''
+        if print_state:
+            update_master(self.json_path, print_state)
 
     def _convert_to_pdf(self, pdf, repeatables, write_common_attribute=False):
         # add one time attributes
@@ -153,27 +302,36 @@ class ECGReport:
         is_first_row = write_common_attribute
         repeatables(pdf, self.method, is_first_row)
 
+    @instrument.span('report.run')
     def run(self, unique_p_id):
+        # 한 process에서 여러 환자를 출력할 수 있도록 page / name 상태 초기화
+        self.common_attribute = CommonAttribute(**self.meta)
+
         # set patient name
-        p_name = get_attribute_from_dataframe(df = self.technician_df, p_id=unique_p_id)
+        p_name = get_attribute_from_dataframe(df = self.technician_index, p_id=unique_p_id)
         self.common_attribute.update_attribute('name', p_name)
 
         # make pdf
-        pdf, pdf_path = self._make_pdf(unique_p_id, p_name)
+        pdf, contents, pdf_path = self._make_pdf(unique_p_id, p_name)
 
-        # brute-force search (query: unique patient id)
+        # patient index lookup (query: unique patient id)
         json_keys = self._get_patient_keys(unique_p_id)
         # # of total pages
         total_pages = int( len(json_keys) / 2  + 0.5) + self.cover_page
         self.common_attribute.update_attribute('page', total_pages)
                 
+        page_span = None
         for i, key in enumerate(json_keys):
+            if i%2 == 0: # 한 page에 record 2개
+                page_span = instrument.span('report.page').start()
    
             self._convert_to_pdf(
                 pdf = pdf,
                 repeatables = PatientSpecificAttribute(
                     recorded_time = self._get_patient_attribute(key, 'recorded_time'),
-                    ecg_images = self._get_patient_attribute(key, 'img_name'),
+                    ecg_images = None if self.vector_wave else self._get_patient_attribute(key, 'img_name'),
+                    ecg_waves = self._get_patient_waves(key) if self.vector_wave else None,
+                    wave_color = self.line_color,
                     jargon = self._get_patient_attribute(key, 'annotation_info'),
                     render_dir = self.render_dir
                 ),
@@ -182,27 +340,148 @@ class ECGReport:
 
             if i%2 != 0:
                 pdf.showPage()
-            # mark flag
-            self.patient_master_dict[key]['is_printed'] = True
+                page_span.stop()
+        if page_span is not None: # record 수가 홀수이면 마지막 page는 pdf.save()에서 닫힘
+            page_span.stop()
            
         pdf.save()
-        self._merge_pdf(pdf_path)
+        final_pdf_path = self._merge_pdf(contents, pdf_path)
 
-        #! update json 
-        #self.write_json()
-        return 
+        # mark flag (master 파일은 save_print_state() 에서 한 번에 저장)
+        self.last_print_state = self.get_print_state(json_keys, final_pdf_path)
+        self.mark_printed(self.last_print_state)
+        return final_pdf_path
 
-    def _merge_pdf(self, contents_pdf_path):
-        merger = PdfFileMerger()
-        merger.append(PdfFileReader(open(self.cover_pdf, 'rb')))
-        merger.append(PdfFileReader(open(contents_pdf_path, 'rb')))
+    def get_print_state(self, json_keys, pdf_path):
+        '''
+            출력한 record 별 print 상태 (다음 incremental 실행에서 바뀐 annotation을 찾는 기준)
+        '''
+        printed_time = str(datetime.now())
+        return {
+            key : {
+                'is_printed' : True,
+                'printed_time' : printed_time,
+                'printed_annotation_time' : self.patient_master_dict[key].get('annotation_time'),
+                'report_path' : pdf_path,
+            }
+            for key in json_keys
+        }
+
+    def mark_printed(self, print_state):
+        for key, state in print_state.items():
+            if key in self.patient_master_dict:
+                self.patient_master_dict[key].update(state)
+
+    @instrument.span('report.merge_pdf')
+    def _merge_pdf(self, contents, final_pdf_path):
+        '''
+            args:
+                contents (io.BytesIO) : 본문 pdf
+                final_pdf_path (str) : cover + 본문을 저장할 경로
+        '''
+        writer = PdfFileWriter()
+        for page in load_cover_pages(self.cover_pdf):
+            writer.addPage(page)
+
+        contents.seek(0)
+        contents_reader = PdfFileReader(contents)
+        for i in range(contents_reader.getNumPages()):
+            writer.addPage(contents_reader.getPage(i))
         
         try:
-            merger.write('(final)'+contents_pdf_path)
+            with open(final_pdf_path, 'wb') as f:
+                writer.write(f)
         except:
             print('Can not merge pdf files.')
             exit(1)
 
+        return final_pdf_path
+
+    def get_unprinted_patient_ids(self):
+        '''
+            새로 annotation 되었거나 마지막 출력 이후 annotation이 바뀐 record가 있는 환자 목록
+        '''
+        if self.patient_index is None:
+            return self.patient_master_dict.unprinted_patient_ids()
+
+        ret = []
+        for unique_p_id in self.patient_index.patients:
+            for key in self.patient_index.get(unique_p_id):
+                record = self.patient_master_dict[key]
+                if needs_report(record):
+                    ret.append(unique_p_id)
+                    break
+        return ret
+
+    def run_batch(self, patient_ids, num_workers=1, manifest_path=None, write_state=True, **kwargs):
+        '''
+            여러 환자 report를 생성하고 결과 PDF / 소요 시간을 manifest json으로 저장
+
+            args:
+                patient_ids (list) : unique patient id 목록
+                num_workers (int) : 1 이하면 현재 process에서 순차 실행,
+                                    그 외에는 worker process마다 ECGReport(**kwargs)를 한 번만 생성
+                kwargs : worker process에서 ECGReport를 만들 때 사용할 인자 (num_workers > 1 일 때 필요)
+                write_state (bool) : 성공한 report의 print 상태를 master에 저장
+
+            worker는 master를 쓰지 않고, 모든 worker가 끝난 뒤 현재 process에서 한 번만 저장한다.
+        '''
+        start = time.time()
+        if num_workers is None or num_workers <= 1:
+            results = [_run_report(self, p_id) for p_id in patient_ids]
+        else:
+            with ProcessPoolExecutor(
+                max_workers = num_workers,
+                initializer = _init_report_worker,
+                initargs = (kwargs,)
+            ) as executor:
+                results = list(executor.map(_run_report_worker, patient_ids))
+
+        print_states = {}
+        for result in results:
+            print_state = result.pop('print_state')
+            if print_state is not None:
+                self.mark_printed(print_state)
+                print_states.update(print_state)
+                result['num_records'] = len(print_state)
+        if write_state:
+            self.save_print_state(print_states)
+
+        manifest = {
+            'created' : str(datetime.now()),
+            'num_workers' : num_workers,
+            'elapsed' : time.time() - start,
+            'reports' : results,
+        }
+        if manifest_path is not None:
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent='\t', ensure_ascii = False)
+
+        return manifest
+
+
+def _run_report(app, unique_p_id):
+    start = time.time()
+    result = {'patient_id' : unique_p_id, 'pdf' : None, 'error' : None, 'print_state' : None}
+    try:
+        result['pdf'] = app.run(unique_p_id)
+        result['print_state'] = app.last_print_state
+    except (Exception, SystemExit) as e: # 한 환자 실패가 batch 전체를 멈추지 않도록
+        result['error'] = repr(e)
+    result['elapsed'] = time.time() - start
+    return result
+
+
+# worker process 당 하나씩 생성 (master json, technician csv, font는 worker 시작 시 한 번만 로드)
+_worker_report = None
+
+def _init_report_worker(kwargs):
+    global _worker_report
+    _worker_report = ECGReport(**kwargs)
+
+def _run_report_worker(unique_p_id):
+    return _run_report(_worker_report, unique_p_id)
+
 
 
         
@@ -218,6 +497,9 @@ def opt():
     parser.add_argument('--master_json', type=str, default='./sample2.json')        # master json 파일
     parser.add_argument('--technician_csv', type=str, default='./technician.csv')   # technician csv 파일
     parser.add_argument('--render_dir', type=str, default='./render_vis')           # 렌더링 이미지가 저장되어 있는 경로
+    parser.add_argument('--lazy_json', action='store_true')                         # master json record를 필요할 때만 읽음
+    parser.add_argument('--wave_dir', type=str, default=None)                       # binary wave 저장 경로 (default: <master_json>_wave)
+    parser.add_argument('--vector_wave', action='store_true')                       # 렌더링 png 대신 vector path로 ecg wave 출력
 
     ''' ------------------------------ 리소스 ------------------------------ '''
     parser.add_argument('--title', type=str, default='Watch형 심전도 연구과제')          # 환자 리포트 타이틀
@@ -227,21 +509,27 @@ def opt():
     parser.add_argument('--cover', type=str, default='./resource/cover.pdf')
     ''' ------------------------------ output 경로 ------------------------------ '''
     parser.add_argument('--pdf_dir', type=str, default='./pdf_results')             # 결과 PDF 파일이 저장될 경로
+    ''' ------------------------------ batch ------------------------------ '''
+    parser.add_argument('--patient_ids', type=str, nargs='*', default=None)         # 출력할 unique patient id 목록
+    parser.add_argument('--incremental', '--all_unprinted', dest='incremental', action='store_true') # 새로 annotation 되었거나 바뀐 record가 있는 환자만 출력
+    parser.add_argument('--num_workers', type=int, default=1)                       # report 생성 process 수
+    parser.add_argument('--manifest', type=str, default=None)                       # batch 결과 manifest json (default: <pdf_dir>/manifest.json)
     
     return parser.parse_args()
 
 def main():
     args = opt()
 
-    #! (목요일) 환자 unique patient ID 입력 -> 모든 csv parsing 후 report 생성
-    args.patient_id = 'A-2106161442' # unique patient id
-    
-    app = ECGReport(
+    kwargs = dict(
         master_json = args.master_json,       # master json 파일
         technician_csv = args.technician_csv, # technician csv 파일
+        lazy_json = args.lazy_json,           # master json lazy reader 사용 여부
         pdf_method = PDF,                     # PDF 생성 방법 (library)
         pdf_root = args.pdf_dir,              # PDF 저장 디렉터리
         render_dir = args.render_dir,         # 렌더링 이미지가 저장되어 있는 경로
+        wave_dir = args.wave_dir,             # binary wave 저장 경로
+        vector_wave = args.vector_wave,       # True : 렌더링 이미지 대신 waveform을 vector로 그림
+        line_color = '#e35f62',               # vector wave 색상
         meta = dict(
             cover=args.cover,   # 커버 PDF
             cover_page= 1,      # 커버 PDF 페이지 수 TODO : parse from given pdf
@@ -251,8 +539,29 @@ def main():
             legend_board=args.legend_board # 그레이 보드 범례
         )   
     )
-
-    app.run(args.patient_id) # 환자 ID를 입력 
+    app = ECGReport(**kwargs)
+
+    if args.patient_ids is None and not args.incremental:
+        #! (목요일) 환자 unique patient ID 입력 -> 모든 csv parsing 후 report 생성
+        args.patient_id = 'A-2106161442' # unique patient id
+        app.run(args.patient_id) # 환자 ID를 입력 
+        app.save_print_state(app.last_print_state)
+        return
+
+    patient_ids = args.patient_ids if args.patient_ids is not None else []
+    if args.incremental:
+        patient_ids += [p_id for p_id in app.get_unprinted_patient_ids() if p_id not in patient_ids]
+        if len(patient_ids) == 0:
+            print('no new or changed annotations')
+            return
+
+    if args.manifest is None:
+        args.manifest = os.path.join(args.pdf_dir, 'manifest.json')
+
+    manifest = app.run_batch(patient_ids, num_workers=args.num_workers, manifest_path=args.manifest, **kwargs)
+    num_failed = len([r for r in manifest['reports'] if r['error'] is not None])
+    print('{} reports ({} failed) in {:.1f}s -> {}'.format(
+        len(manifest['reports']), num_failed, manifest['elapsed'], args.manifest))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,362 @@
+import os
+import json
+import sqlite3
+import argparse
+import threading
+
+import numpy as np
+from tqdm import tqdm
+
+from collections.abc import MutableMapping
+
+from patient_index import get_unique_patient_id
+
+
+WAVE_TYPES = ('raw_ecg_wave_voltage', 'denoised_ecg_wave_voltage')
+WAVE_COLUMNS = ('raw_wave', 'denoised_wave')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,  -- master json의 key 순서
+    key TEXT UNIQUE NOT NULL,
+    patient_id TEXT,
+    recorded_time TEXT,
+    is_annotated INTEGER NOT NULL DEFAULT 0,
+    is_printed INTEGER NOT NULL DEFAULT 0,
+    annotation_time TEXT,
+    data TEXT NOT NULL,                     -- wave를 뺀 record 전체 (json)
+    wave_dtype TEXT,
+    raw_wave BLOB,
+    denoised_wave BLOB
+);
+CREATE INDEX IF NOT EXISTS idx_patient ON records (patient_id, recorded_time);
+CREATE INDEX IF NOT EXISTS idx_recorded_time ON records (recorded_time);
+CREATE INDEX IF NOT EXISTS idx_annotated ON records (is_annotated, seq);
+CREATE INDEX IF NOT EXISTS idx_printed ON records (is_annotated, is_printed, patient_id);
+CREATE INDEX IF NOT EXISTS idx_annotation_time ON records (annotation_time);
+'''
+
+# 출력된 적이 없거나, 출력 이후 annotation이 바뀐 record (report.needs_report 와 같은 조건)
+_NEEDS_REPORT = '''is_annotated = 1 AND (
+    is_printed = 0 OR json_extract(data, '$.printed_annotation_time') IS NOT annotation_time
+)'''
+
+
+def is_sqlite_path(path):
+    return os.path.splitext(str(path))[1].lower() in ('.db', '.sqlite', '.sqlite3')
+
+
+class SQLiteRecord(dict):
+    '''
+        SQLiteMasterStore의 record 하나. 일반 dict와 같이 쓰되 wave (BLOB)는 처음 접근할 때 읽는다.
+
+        record[wave_type] 은 read-only np.ndarray, 새 wave를 대입하면 save() 때 BLOB으로 저장된다.
+    '''
+    def __init__(self, store, key, fields, has_wave, data=None):
+        super().__init__(fields)
+        self._store = store
+        self._key = key
+        self._has_wave = has_wave
+        self._waves = {}
+        self._data = data # 마지막으로 저장된 json (변경 여부 비교용)
+
+    def __contains__(self, name):
+        if name in WAVE_TYPES and self._has_wave:
+            return True
+        return super().__contains__(name)
+
+    def __getitem__(self, name):
+        if name in WAVE_TYPES and not super().__contains__(name) and self._has_wave:
+            if name not in self._waves:
+                self._waves[name] = self._store._load_wave(self._key, name)
+            return self._waves[name]
+        return super().__getitem__(name)
+
+    def to_dict(self):
+        '''
+            wave까지 포함한 일반 dict (다른 process로 넘기거나 json으로 내보낼 때)
+        '''
+        ret = dict(self)
+        for wave_type in WAVE_TYPES:
+            if wave_type in self:
+                ret[wave_type] = self[wave_type]
+        return ret
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+
+class SQLiteMasterStore(MutableMapping):
+    '''
+        master json 대신 쓸 수 있는 SQLite 저장소 (parse_json / write_json 에 .db / .sqlite 경로를 주면 사용)
+
+        - record는 접근할 때 읽고, save()는 읽었거나 대입한 record 중 바뀐 row만 한 transaction으로 갱신
+        - patient_id, recorded_time, is_annotated, is_printed, annotation_time 은 index column
+          (count / next_unannotated / unprinted_* 는 저장된 상태 기준 query)
+        - wave는 record 당 BLOB 두 개 (raw, denoised)
+    '''
+    def __init__(self, db_path, dtype='float32'):
+        self.json_path = db_path
+        self.dtype = np.dtype(dtype)
+
+        # GUI thread와 prefetch thread가 같이 읽으므로 connection 사용은 lock으로 직렬화
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._conn.execute('PRAGMA journal_mode=WAL') # 저장 중에도 다른 process가 읽을 수 있게
+        self._conn.executescript(_SCHEMA)
+
+        self._keys = [key for (key,) in self._query('SELECT key FROM records ORDER BY seq')]
+        self._key_set = set(self._keys)
+        self._records = {}
+        self._deleted = set()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _load_wave(self, key, wave_type):
+        column = WAVE_COLUMNS[WAVE_TYPES.index(wave_type)]
+        dtype, blob = self._query(
+            'SELECT wave_dtype, {} FROM records WHERE key = ?'.format(column), (key,)
+        )[0]
+        return np.frombuffer(blob, dtype=np.dtype(dtype))
+
+    def __getitem__(self, key):
+        if key not in self._records:
+            rows = self._query('SELECT data, raw_wave IS NOT NULL FROM records WHERE key = ?', (key,))
+            if len(rows) == 0 or key in self._deleted:
+                raise KeyError(key)
+            data, has_wave = rows[0]
+            self._records[key] = SQLiteRecord(self, key, json.loads(data), bool(has_wave), data)
+        return self._records[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._key_set:
+            self._keys.append(key)
+            self._key_set.add(key)
+        self._deleted.discard(key)
+        self._records[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+        self._records.pop(key, None)
+        self._keys.remove(key)
+        self._key_set.remove(key)
+        self._deleted.add(key)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._key_set
+
+    def release(self, key):
+        '''
+            저장된 record를 메모리에서 내린다. (변경 내용은 버려짐)
+        '''
+        self._records.pop(key, None)
+
+    def _save_record(self, key, record):
+        fields = {k: v for k, v in dict.items(record) if k not in WAVE_TYPES}
+        data = json.dumps(fields, ensure_ascii = False)
+        waves = [dict.get(record, wave_type) for wave_type in WAVE_TYPES]
+        has_new_wave = any(wave is not None for wave in waves)
+
+        if isinstance(record, SQLiteRecord) and record._data == data and not has_new_wave:
+            return False
+
+        self._conn.execute(
+            '''INSERT INTO records (key, patient_id, recorded_time, is_annotated, is_printed, annotation_time, data)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (key) DO UPDATE SET
+                   patient_id = excluded.patient_id, recorded_time = excluded.recorded_time,
+                   is_annotated = excluded.is_annotated, is_printed = excluded.is_printed,
+                   annotation_time = excluded.annotation_time, data = excluded.data''',
+            (
+                key, get_unique_patient_id(key, fields), fields.get('recorded_time'),
+                int(bool(fields.get('is_annotated'))), int(bool(fields.get('is_printed'))),
+                fields.get('annotation_time'), data
+            )
+        )
+        if has_new_wave:
+            raw, denoised = [np.ascontiguousarray(wave, dtype=self.dtype).tobytes() for wave in waves]
+            self._conn.execute(
+                'UPDATE records SET wave_dtype = ?, raw_wave = ?, denoised_wave = ? WHERE key = ?',
+                (self.dtype.str, raw, denoised, key)
+            )
+
+        if isinstance(record, SQLiteRecord):
+            record._data = data
+        return True
+
+    def save(self, keys=None):
+        '''
+            args:
+                keys (list) : 저장할 key 목록, None이면 메모리에 있는 record 전체 (바뀐 row만 씀)
+            return:
+                갱신한 row 수
+        '''
+        if keys is None:
+            keys = list(self._records.keys())
+
+        cnt = 0
+        with self._lock, self._conn: # 하나의 transaction
+            for key in self._deleted:
+                self._conn.execute('DELETE FROM records WHERE key = ?', (key,))
+            self._deleted.clear()
+            for key in keys:
+                if key in self._records:
+                    cnt += self._save_record(key, self._records[key])
+        return cnt
+
+    def count(self, **conditions):
+        '''
+            ex) count(is_annotated=True)
+        '''
+        where, params = self._where(conditions)
+        return self._query('SELECT COUNT(*) FROM records' + where, params)[0][0]
+
+    def _where(self, conditions):
+        clauses, params = [], []
+        for column, value in conditions.items():
+            if column not in ('patient_id', 'recorded_time', 'is_annotated', 'is_printed', 'annotation_time'):
+                raise ValueError('{} is not an indexed column'.format(column))
+            if isinstance(value, bool):
+                value = int(value)
+            clauses.append('{} = ?'.format(column))
+            params.append(value)
+        if len(clauses) == 0:
+            return '', params
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+    def next_unannotated(self, after_key=None):
+        '''
+            after_key 다음 (master 순서)의 annotation 안 된 key, 없으면 None
+        '''
+        seq = -1
+        if after_key is not None:
+            seq = self._query('SELECT seq FROM records WHERE key = ?', (after_key,))[0][0]
+        rows = self._query('SELECT key FROM records WHERE is_annotated = 0 AND seq > ? ORDER BY seq LIMIT 1', (seq,))
+        return None if len(rows) == 0 else rows[0][0]
+
+    def unannotated_keys(self):
+        return [key for (key,) in self._query('SELECT key FROM records WHERE is_annotated = 0 ORDER BY seq')]
+
+    def field_values(self, field):
+        '''
+            저장된 모든 record의 field 값만 json_extract로 읽는다. (record / wave BLOB을 메모리에 올리지 않음)
+
+            return:
+                dict (key -> 값, field가 없으면 None, json true / false는 1 / 0)
+        '''
+        path = '$."{}"'.format(field)
+        ret = {}
+        for key, value, value_type in self._query(
+            'SELECT key, json_extract(data, ?), json_type(data, ?) FROM records ORDER BY seq', (path, path)
+        ):
+            if value_type in ('array', 'object'):
+                value = json.loads(value)
+            ret[key] = value
+        return ret
+
+    def patient_keys(self, patient_id):
+        '''
+            환자의 key 목록 (recorded_time 순)
+        '''
+        return [key for (key,) in self._query(
+            'SELECT key FROM records WHERE patient_id = ? ORDER BY recorded_time, seq', (patient_id,)
+        )]
+
+    def unprinted_keys(self, patient_id):
+        '''
+            새로 annotation 되었거나 출력 이후 바뀐 환자의 key 목록 (recorded_time 순)
+        '''
+        return [key for (key,) in self._query(
+            '''SELECT key FROM records WHERE patient_id = ? AND ''' + _NEEDS_REPORT + '''
+               ORDER BY recorded_time, seq''', (patient_id,)
+        )]
+
+    def unprinted_patient_ids(self):
+        return [p_id for (p_id,) in self._query(
+            '''SELECT patient_id FROM records WHERE ''' + _NEEDS_REPORT + '''
+               GROUP BY patient_id ORDER BY MIN(seq)'''
+        )]
+
+    def to_dict(self):
+        '''
+            wave를 list로 바꾼 일반 dict (json 내보내기용)
+
+            여기서 읽은 record만 다시 내린다. (이미 메모리에 있던 record는 저장 전 변경이 있을 수 있음)
+        '''
+        ret = {}
+        for key in self:
+            loaded = key not in self._records
+            record = self[key]
+            ret[key] = record.to_dict() if isinstance(record, SQLiteRecord) else dict(record)
+            for wave_type in WAVE_TYPES:
+                if isinstance(ret[key].get(wave_type), np.ndarray):
+                    ret[key][wave_type] = ret[key][wave_type].tolist()
+            if loaded:
+                self.release(key)
+        return ret
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--master_json', type=str, default='./sample2.json')  # master json 파일 경로
+    parser.add_argument('--db', type=str, default=None)                      # 결과 sqlite 경로 (default: <master_json>.db)
+    parser.add_argument('--wave_dir', type=str, default=None)                # binary wave 저장 경로 (default: <master_json>_wave)
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float64'])
+    parser.add_argument('--batch_size', type=int, default=1000)              # transaction 당 record 수
+    parser.add_argument('--to_json', action='store_true')                    # 반대로 --db 를 --master_json 으로 내보냄
+    return parser.parse_args()
+
+def main():
+    from utils import parse_json, write_json
+    from waveform_store import WaveformStore
+
+    args = opt()
+    if args.db is None:
+        args.db = os.path.splitext(args.master_json)[0] + '.db'
+
+    if args.to_json:
+        store = SQLiteMasterStore(args.db)
+        write_json(args.master_json, store.to_dict())
+        store.close()
+        print('{} -> {}'.format(args.db, args.master_json))
+        return
+
+    if args.wave_dir is None:
+        args.wave_dir = WaveformStore.default_dir(args.master_json)
+    wave_store = WaveformStore(args.wave_dir)
+
+    patient_dict, _ = parse_json(args.master_json, lazy=True)
+    store = SQLiteMasterStore(args.db, dtype=args.dtype)
+    for i, key in enumerate(tqdm(patient_dict)):
+        record = dict(patient_dict[key])
+        if WaveformStore.REF_KEY in record: # binary store의 wave를 BLOB으로 옮긴다
+            for wave_type in WAVE_TYPES:
+                record[wave_type] = wave_store.get(record, wave_type)
+            del record[WaveformStore.REF_KEY]
+        store[key] = record
+        patient_dict.release(key)
+
+        if (i+1) % args.batch_size == 0:
+            store.save()
+            for saved_key in store:
+                store.release(saved_key)
+    store.save()
+    print('{} records -> {}'.format(len(store), args.db))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
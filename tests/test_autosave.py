@@ -0,0 +1,65 @@
+import json
+import multiprocessing
+
+import pytest
+
+from utils import parse_json, write_json
+from annotation_journal import AnnotationJournal, AutosaveWriter
+
+
+NUM_RECORDS = 30
+
+
+def _make_master(json_path):
+    write_json(json_path, {
+        '{}-{}'.format(prefix, i) : {
+            'is_annotated' : False,
+            'annotation_info' : [],
+            'annotation_time' : None,
+            'LR' : list(range(100)), # 원본 byte 복사 구간이 충분히 길도록
+        }
+        for prefix in ('a', 'b') for i in range(NUM_RECORDS)
+    })
+
+
+def _annotate(json_path, prefix):
+    '''
+        ECG_GUI 하나처럼 자기 record를 하나씩 annotation 하고 매번 autosave
+    '''
+    journal = AnnotationJournal(json_path, '{}.{}.journal'.format(json_path, prefix))
+    writer = AutosaveWriter(json_path, journal, retry_interval=0.01)
+    for i in range(NUM_RECORDS):
+        writer.submit({'{}-{}'.format(prefix, i) : {
+            'is_annotated' : True,
+            'annotation_info' : [prefix],
+            'annotation_time' : str(i),
+        }})
+        writer.flush()
+    if not writer.close():
+        raise RuntimeError('autosave failed')
+
+
+@pytest.mark.parametrize('file_name', ['m.json', 'm.db'])
+def test_two_autosave_writers_share_master(tmp_path, file_name):
+    json_path = str(tmp_path / file_name)
+    _make_master(json_path)
+
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_annotate, args=(json_path, prefix)) for prefix in ('a', 'b')]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join(60)
+    assert [proc.exitcode for proc in procs] == [0, 0]
+
+    if file_name.endswith('.json'):
+        with open(json_path, 'r') as f:
+            json.load(f) # 깨지지 않은 json
+
+    data, _ = parse_json(json_path)
+    assert len(data) == 2 * NUM_RECORDS
+    for key in data:
+        record = data[key]
+        assert record['is_annotated'] is True, key
+        assert record['annotation_info'] == [key.split('-')[0]]
+        assert record['LR'] == list(range(100))
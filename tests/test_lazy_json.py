@@ -0,0 +1,30 @@
+import io
+import json
+
+import pytest
+
+from lazy_json import build_offset_index
+
+
+def _make_master():
+    return {
+        'A-{}-환자-{}'.format(i, 'x' * (i % 7)) : {
+            'patient_id' : 'A-{}'.format(i),
+            'annotation_info' : ['정상', 'PVC'][:i % 3],
+            'LR' : list(range(i % 11)),
+            'memo' : '"따옴표" \\ {괄호}',
+        }
+        for i in range(40)
+    }
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 100, 257, 1024, 4096, 1<<24])
+def test_build_offset_index_small_chunks(chunk_size):
+    master = _make_master()
+    raw = json.dumps(master, indent='\t', ensure_ascii = False).encode('utf-8')
+
+    index = build_offset_index(io.BytesIO(raw), chunk_size=chunk_size)
+
+    assert list(index) == list(master)
+    for key, (off, length) in index.items():
+        assert json.loads(raw[off:off+length]) == master[key]
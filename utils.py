@@ -1,8 +1,21 @@
 from abc import ABC, abstractmethod
 import os
 import json
+import pickle
+import numpy as np
 import pandas as pd
 
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # windows : lock 없이 동작 (한 명만 master를 쓰는 기존 사용법)
+    fcntl = None
+
+import instrument
+from lazy_json import LazyMasterJSON, write_records, save_index
+from sqlite_store import SQLiteMasterStore, is_sqlite_path
+
 
 # TODO : 진단명 -> 환자가 이해할 수 있는 단어로 변환
 class Jargon2HumanWord:
@@ -22,21 +35,206 @@ class DiagnosisKeyMapper:
         'z': 'artifact'
     }
 
+    # 확대 / 이동 (annotation 과 무관)
+    view_key_dict = {
+        '+': 'zoom_in',
+        '=': 'zoom_in',
+        '-': 'zoom_out',
+        '[': 'pan_left',
+        ']': 'pan_right',
+        '0': 'reset_view',
+    }
+
 
-def parse_json(json_path):
-    with open(json_path, 'r') as f:
-        data = json.load(f)
+@instrument.span('parse_json')
+def parse_json(json_path, lazy=False):
+    if is_sqlite_path(json_path): # sqlite master (record는 항상 접근 시점에 읽음)
+        data = SQLiteMasterStore(json_path)
+    elif lazy: # record는 접근 시점에 읽음
+        data = LazyMasterJSON(json_path)
+    else:
+        with open(json_path, 'r') as f:
+            data = json.load(f)
 
     patient_idx_list = list(range(len(data.keys())))
     
     return data, patient_idx_list
 
+@instrument.span('write_json')
+def write_json(json_path, data):
+    if isinstance(data, LazyMasterJSON):
+        data.dump(json_path)
+        return
+
+    if is_sqlite_path(json_path): # 바뀐 row만 transaction 하나로 갱신
+        if isinstance(data, SQLiteMasterStore) and data.json_path == json_path:
+            data.save()
+            return
+        store = SQLiteMasterStore(json_path)
+        for key in [k for k in store if k not in data]:
+            del store[key]
+        for key in data:
+            store[key] = data[key]
+        store.save()
+        store.close()
+        return
+
+    if isinstance(data, SQLiteMasterStore): # sqlite -> json 내보내기
+        data = data.to_dict()
+
+    # 저장 도중 중단되어도 master json이 깨지지 않도록 tmp 파일에 쓰고 교체
+    tmp_path = '{}.{}.tmp'.format(json_path, os.getpid()) # 여러 process가 같은 master를 저장할 수 있음
+    with open(tmp_path, 'wb') as f:
+        index = write_records(f, data.items())
+        f.flush()
+        stat = os.fstat(f.fileno())
+    os.replace(tmp_path, json_path)
+    save_index(json_path + '.idx', index, stat) # 다음 lazy open이 인덱스를 다시 만들지 않도록
+
+@contextmanager
+def lock_master(json_path):
+    '''
+        master를 읽고 -> 고치고 -> 쓰는 동안 다른 process / thread의 같은 작업을 막는 '<master>.lock' 배타 lock
+        (같은 process 안에서 중첩해서 잡으면 안 됨)
+    '''
+    with open(json_path + '.lock', 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def update_master(json_path, changes):
+    '''
+        lock을 잡고 디스크의 master를 다시 열어 changes (key -> 덮어쓸 field dict)만 반영하고 저장
+        (메모리에 들고 있던 오래된 master 전체를 다시 쓰지 않는다)
+
+        return:
+            반영한 record 수
+    '''
+    with lock_master(json_path):
+        data, _ = parse_json(json_path, lazy=True)
+        try:
+            cnt = 0
+            for key, fields in changes.items():
+                if key in data:
+                    data[key].update(fields)
+                    cnt += 1
+            if cnt > 0:
+                write_json(json_path, data)
+        finally:
+            data.close()
+    return cnt
+
+def minmax_decimate(data, columns):
+    '''
+        column 당 (min, max) 두 샘플만 남겨 그릴 점 수를 줄인다. 샘플 순서를 유지하기 위해 먼저 나온 쪽을 앞에 둔다.
+
+        args:
+            data (np.ndarray) : 1d wave
+            columns (int) : 출력 폭 (pixel 또는 pt)
+        return:
+            (sample index, sample value) - 샘플이 2 * columns 이하이면 그대로
+    '''
+    n = len(data)
+    columns = max(int(columns), 1)
+    if n <= 2 * columns:
+        return np.arange(n, dtype=np.float64), data
+
+    per_col = -(-n // columns) # ceil
+    columns = -(-n // per_col)
+    padded = np.pad(data, (0, columns * per_col - n), mode='edge').reshape(columns, per_col)
+
+    arg_min = padded.argmin(axis=1)
+    arg_max = padded.argmax(axis=1)
+    first = np.minimum(arg_min, arg_max)
+    second = np.maximum(arg_min, arg_max)
+
+    rows = np.arange(columns)
+    idx = np.empty(columns * 2, dtype=np.int64)
+    idx[0::2] = rows * per_col + first
+    idx[1::2] = rows * per_col + second
+    idx = np.minimum(idx, n - 1)
+    return idx.astype(np.float64), data[idx]
+
 def parse_csv(csv_file):
     return pd.read_csv(csv_file)
 
+
+class TechnicianIndex:
+    '''
+        technician csv에서 필요한 column만 읽어 id -> row 값 hash index를 만드는 기능
+
+        '<csv>.idx.pkl' sidecar (cache_dir를 주면 '<cache_dir>/<csv 이름>.idx.pkl')에 (size, mtime)과 함께 캐시한다.
+        캐시를 쓸 수 없으면 (read-only 디렉토리 등) 메모리 index만 사용한다.
+    '''
+    columns = {'id' : str, 'name' : str}
+
+    def __init__(self, csv_file, use_cache=True, cache_dir=None):
+        self.csv_file = csv_file
+        self.cache_path = csv_file + '.idx.pkl'
+        if cache_dir is not None:
+            self.cache_path = os.path.join(cache_dir, os.path.basename(csv_file) + '.idx.pkl')
+        self.use_cache = use_cache
+        self.index = self._load()
+
+    def _file_stat(self):
+        stat = os.stat(self.csv_file)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load(self):
+        file_stat = self._file_stat()
+        if self.use_cache and os.path.isfile(self.cache_path):
+            try:
+                with open(self.cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+                if cached['stat'] == file_stat:
+                    return cached['index']
+            except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+                pass
+
+        df = pd.read_csv(self.csv_file, usecols=list(self.columns), dtype=self.columns)
+        index = {}
+        for row in df.itertuples(index=False):
+            row = row._asdict()
+            index.setdefault(row['id'], row) # 같은 id가 여러 번 있으면 첫 번째 행 (기존 동작)
+
+        if self.use_cache:
+            self._save(file_stat, index)
+        return index
+
+    def _save(self, file_stat, index):
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'stat' : file_stat, 'index' : index}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print('technician index cache not saved ({!r}), using in-memory index'.format(e))
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, p_id, attribute='name'):
+        return self.index[p_id][attribute]
+
+    def get_many(self, p_ids, attribute='name'):
+        '''
+            여러 환자를 한 번에 조회, 없는 id는 None
+        '''
+        return {p_id : self.index[p_id][attribute] if p_id in self.index else None for p_id in p_ids}
+
+    def __contains__(self, p_id):
+        return p_id in self.index
+
+
 def get_attribute_from_dataframe(df, p_id=None, dict_key=None):
     if p_id is None:
         p_id = dict_key.split('_')[0]
+
+    if isinstance(df, TechnicianIndex):
+        return df.get(p_id, 'name')
         
     row = df.loc[df['id'] == p_id]
     patient_name = row['name'].to_list()
@@ -74,6 +272,10 @@ class PatientSpecificAttribute(BaseAttribute):
             'ecg_images' : kwargs.get('ecg_images'),
         }
         self.render_dir = kwargs.get('render_dir')
+
+        # [(raw chunk, denoised chunk), ...] 가 주어지면 png 대신 vector path로 그린다
+        self.ecg_waves = kwargs.get('ecg_waves')
+        self.wave_color = kwargs.get('wave_color')
         self._build_organization_param()
         
     def _build_organization_param(self):
@@ -120,7 +322,17 @@ class PatientSpecificAttribute(BaseAttribute):
             offset = 3
 
         for k, v in self.attribute_dict.items():
-            if k in self.size_dict.keys(): # image
+            if k == 'ecg_images' and self.ecg_waves is not None: # vector wave
+                for i, (raw, denoised) in enumerate(self.ecg_waves):
+                    method.drawWave(
+                        pdf = pdf,
+                        waves = [raw, denoised],
+                        labels = ['Original {}/3'.format(i+1), 'Denoised {}/3'.format(i+1)],
+                        location = self.location_dict[k][i+offset],
+                        size = self.size_dict[k],
+                        color = self.wave_color
+                    )
+            elif k in self.size_dict.keys(): # image
                 if isinstance(v, list):
                     for i, img in enumerate(v):
                         method.drawImage(
@@ -174,6 +386,10 @@ class CommonAttribute(BaseAttribute):
             'logo' : kwargs.get('logo'),
             'diagnosis' : [],
         }
+        # page마다 같은 attribute (form XObject로 한 번만 그림)
+        self.static_keys = ('title', 'board', 'legend_board', 'logo')
+        self.template_name = 'CommonAttribute'
+        self.use_template = kwargs.get('use_template', True)
         
         self._build_organization_param() # location setup
 
@@ -243,7 +459,10 @@ class CommonAttribute(BaseAttribute):
 
         return color, fill
 
-    def __call__(self, pdf, method):
+    def _draw_static(self, pdf, method):
+        '''
+            모든 page에 똑같이 들어가는 부분 (사각형, 제목, 범례, 로고, 보드 이미지)
+        '''
         for k, v in self.shape_dict.items():
             if v == 'rect':
                 color, fill = self._get_color_fill_for_rect(k)
@@ -265,25 +484,43 @@ class CommonAttribute(BaseAttribute):
                 raise ValueError
                 exit(1)
 
+        for k in self.static_keys:
+            self._draw_attribute(pdf, method, k, self.attribute_dict[k])
+
+    def _draw_attribute(self, pdf, method, k, v):
+        if k in self.size_dict.keys(): # image
+            method.drawImage(
+                pdf = pdf,
+                image_path = v,
+                location = self.location_dict[k],
+                size = self.size_dict[k]
+            )
+        else: # text 
+            color, font, scale = self._get_color_font_scale(k)
+            method.drawText(
+                pdf = pdf,
+                text = v,
+                location = self.location_dict[k],
+                color = color,
+                font = font,
+                scale = scale
+            )
+
+    def __call__(self, pdf, method):
+        # 고정 layout은 문서 당 한 번만 form XObject로 만들고 page마다 참조만 한다
+        if self.use_template and hasattr(method, 'doForm'):
+            if not method.hasForm(pdf, self.template_name):
+                method.beginForm(pdf, self.template_name)
+                self._draw_static(pdf, method)
+                method.endForm(pdf)
+            method.doForm(pdf, self.template_name)
+        else:
+            self._draw_static(pdf, method)
 
         for k, v in self.attribute_dict.items():
-            if k in self.size_dict.keys(): # image
-                method.drawImage(
-                    pdf = pdf,
-                    image_path = v,
-                    location = self.location_dict[k],
-                    size = self.size_dict[k]
-                )
-            else: # text 
-                color, font, scale = self._get_color_font_scale(k)
-                method.drawText(
-                    pdf = pdf,
-                    text = v,
-                    location = self.location_dict[k],
-                    color = color,
-                    font = font,
-                    scale = scale
-                )
+            if k in self.static_keys:
+                continue
+            self._draw_attribute(pdf, method, k, v)
                 
             if k == 'page':
                 self._next_page()
@@ -0,0 +1,274 @@
+import os
+import argparse
+import threading
+
+import numpy as np
+from tqdm import tqdm
+
+from collections import OrderedDict
+
+from utils import parse_json, write_json
+
+
+def _lod_sizes(n, factor, min_len):
+    '''
+        level 1, 2, ... 의 길이 (level k 한 칸 = factor**k 샘플), min_len 보다 짧아지면 중단
+    '''
+    sizes = []
+    block = factor
+    while -(-n // block) >= min_len:
+        sizes.append(-(-n // block))
+        block *= factor
+    return sizes
+
+def build_minmax_pyramid(data, factor=4, min_len=64):
+    '''
+        1d wave -> level 별 (min, max) envelope (level of detail pyramid)
+
+        return:
+            (2, total) 배열 : row 0 = min, row 1 = max, level 1부터 차례로 이어 붙인 것
+    '''
+    data = np.asarray(data)
+    lo = hi = data
+    levels = []
+    for size in _lod_sizes(len(data), factor, min_len):
+        pad = size * factor - len(lo)
+        lo = np.pad(lo, (0, pad), mode='edge').reshape(size, factor).min(axis=1)
+        hi = np.pad(hi, (0, pad), mode='edge').reshape(size, factor).max(axis=1)
+        levels.append(np.stack([lo, hi]))
+
+    if len(levels) == 0:
+        return np.zeros((2, 0), dtype=data.dtype)
+    return np.concatenate(levels, axis=1)
+
+def query_envelope(data, lod, start, stop, columns, factor=4, min_len=64):
+    '''
+        data[start:stop] 구간을 최대 columns 칸으로 나눈 (min, max) envelope
+
+        칸 당 샘플 수에 맞는 pyramid level에서 읽으므로 구간 길이 / record 길이와 상관없이 O(columns)
+        lod가 None이면 (json voltage list record) 원본 샘플에서 바로 계산한다.
+
+        return:
+            x (칸 중심의 샘플 위치), lo, hi (np.ndarray, float64)
+    '''
+    n = len(data)
+    start = min(max(int(start), 0), n)
+    stop = min(max(int(stop), start), n)
+    columns = max(int(columns), 1)
+    per_col = (stop - start) / columns
+
+    sizes = _lod_sizes(n, factor, min_len)
+    level = 0
+    if lod is not None:
+        while level < len(sizes) and factor ** (level+1) <= per_col:
+            level += 1
+
+    if level == 0:
+        lo = hi = np.asarray(data[start:stop], dtype=np.float64)
+        x = np.arange(start, stop, dtype=np.float64)
+    else:
+        block = factor ** level
+        offset = sum(sizes[:level-1])
+        b0, b1 = start // block, -(-stop // block)
+        lo = np.asarray(lod[0, offset + b0 : offset + b1], dtype=np.float64)
+        hi = np.asarray(lod[1, offset + b0 : offset + b1], dtype=np.float64)
+        x = (np.arange(b0, b1, dtype=np.float64) + 0.5) * block
+
+    # level 한 칸이 column 보다 작으므로 남은 차이 (factor 배 미만)는 여기서 줄인다
+    per = -(-len(x) // columns)
+    if per > 1:
+        size = -(-len(x) // per)
+        pad = size * per - len(x)
+        lo = np.pad(lo, (0, pad), mode='edge').reshape(size, per).min(axis=1)
+        hi = np.pad(hi, (0, pad), mode='edge').reshape(size, per).max(axis=1)
+        x = np.pad(x, (0, pad), mode='edge').reshape(size, per).mean(axis=1)
+    return x, lo, hi
+
+
+class WaveformStore:
+    '''
+        raw / denoised ecg wave를 record 단위 binary(.npy) 파일로 저장하고,
+        memory mapping으로 열어 zero-copy np.ndarray view를 리턴하는 기능
+
+        master json에는 voltage list 대신 'wave_file' (wave_dir 기준 상대 경로)만 남는다.
+        파일 하나에 (2, N) 배열 : row 0 = raw, row 1 = denoised
+
+        zoom / pan 용 min/max pyramid는 옆에 '<key>.lod.npy' (2 wave, 2 (min, max), level 합) 로 저장한다.
+
+        memmap 하나가 file descriptor 하나를 잡으므로 열린 파일은 max_open 개 LRU로만 유지한다.
+    '''
+    WAVE_TYPES = ('raw_ecg_wave_voltage', 'denoised_ecg_wave_voltage')
+    REF_KEY = 'wave_file'
+    LOD_FACTOR = 4
+    LOD_MIN_LEN = 64
+
+    def __init__(self, wave_dir, dtype='float32', max_open=64):
+        self.wave_dir = wave_dir
+        self.dtype = np.dtype(dtype) # float32 (voltage) 또는 int16 (ADC count)
+        self.max_open = max_open
+        self._mmap_cache = OrderedDict()
+        self._lod_cache = OrderedDict()
+        self._lock = threading.Lock() # GUI thread와 prefetch thread가 같이 사용
+
+    @staticmethod
+    def default_dir(json_path):
+        return os.path.splitext(json_path)[0] + '_wave'
+
+    @staticmethod
+    def _file_name(key):
+        return str(key).replace(os.sep, '_') + '.npy'
+
+    @staticmethod
+    def _lod_file_name(file_name):
+        return os.path.splitext(file_name)[0] + '.lod.npy'
+
+    def _write_array(self, file_name, arr):
+        # 다른 process가 mmap 중일 수 있으므로 tmp 파일에 쓰고 교체
+        file_path = os.path.join(self.wave_dir, file_name)
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp_path, file_path)
+
+    def _write_lod(self, file_name, waves):
+        lod = np.stack([build_minmax_pyramid(wave, self.LOD_FACTOR, self.LOD_MIN_LEN) for wave in waves])
+        self._write_array(self._lod_file_name(file_name), lod.astype(waves[0].dtype, copy=False))
+        with self._lock:
+            self._lod_cache.pop(file_name, None)
+
+    def _cast(self, key, wave):
+        '''
+            정수 dtype (ADC count)에는 정수 값만 받는다. (float voltage를 그대로 넣으면 소수점이 잘려나감)
+        '''
+        wave = np.asarray(wave)
+        if self.dtype.kind not in 'iu':
+            return wave.astype(self.dtype, copy=False)
+
+        info = np.iinfo(self.dtype)
+        if wave.size > 0 and (
+            (wave.dtype.kind == 'f' and not np.array_equal(wave, np.round(wave)))
+            or wave.min() < info.min or wave.max() > info.max
+        ):
+            raise ValueError('{} : {} store needs integer ADC counts in [{}, {}]'.format(
+                key, self.dtype, info.min, info.max))
+        return wave.astype(self.dtype)
+
+    def write(self, key, raw, denoised):
+        raw = self._cast(key, raw)
+        denoised = self._cast(key, denoised)
+        if raw.shape != denoised.shape:
+            raise ValueError('raw/denoised length mismatch for {} : {} vs {}'.format(
+                key, raw.shape, denoised.shape))
+
+        os.makedirs(self.wave_dir, exist_ok=True)
+        file_name = self._file_name(key)
+        self._write_array(file_name, np.stack([raw, denoised]))
+        with self._lock:
+            self._mmap_cache.pop(file_name, None)
+        self._write_lod(file_name, (raw, denoised))
+        return file_name
+
+    def _open_cached(self, cache, file_name, file_path):
+        '''
+            LRU cache에서 memmap을 꺼내고, 넘치면 오래된 것의 참조를 버린다. (view가 없으면 fd도 닫힘)
+        '''
+        with self._lock:
+            if file_name in cache:
+                cache.move_to_end(file_name)
+                return cache[file_name]
+
+        arr = np.load(file_path, mmap_mode='r')
+        with self._lock:
+            cache[file_name] = arr
+            cache.move_to_end(file_name)
+            while len(cache) > self.max_open:
+                cache.popitem(last=False)
+        return arr
+
+    def open(self, file_name):
+        return self._open_cached(self._mmap_cache, file_name, os.path.join(self.wave_dir, file_name))
+
+    def open_lod(self, file_name):
+        '''
+            pyramid 파일이 없으면 (이전 버전으로 저장된 store) 이 시점에 만든다.
+        '''
+        lod_path = os.path.join(self.wave_dir, self._lod_file_name(file_name))
+        if file_name not in self._lod_cache and not os.path.isfile(lod_path):
+            self._write_lod(file_name, self.open(file_name))
+        return self._open_cached(self._lod_cache, file_name, lod_path)
+
+    def get(self, record, wave_type):
+        '''
+            args:
+                record (dict) : master json의 record 하나
+                wave_type (str) : 'raw_ecg_wave_voltage' or 'denoised_ecg_wave_voltage'
+            return:
+                list (기존 json record) 또는 read-only np.memmap view
+        '''
+        if wave_type in record:
+            return record[wave_type]
+        if self.REF_KEY not in record:
+            raise KeyError('record has neither {} nor {}'.format(wave_type, self.REF_KEY))
+
+        return self.open(record[self.REF_KEY])[self.WAVE_TYPES.index(wave_type)]
+
+    def get_chunk(self, record, wave_type, time_step, num_chunks=3):
+        '''
+            wave를 num_chunks 등분했을 때 time_step (1부터) 번째 구간
+        '''
+        data = self.get(record, wave_type)
+        chunk_size = len(data) // num_chunks
+        offset = (time_step-1) * chunk_size
+        return data[ offset : offset + chunk_size ]
+
+    def get_envelope(self, record, wave_type, start, stop, columns):
+        '''
+            wave의 [start, stop) 샘플 구간을 columns 칸 (min, max) envelope으로 리턴 (query_envelope 참고)
+        '''
+        data = self.get(record, wave_type)
+        lod = None
+        if wave_type not in record:
+            lod = self.open_lod(record[self.REF_KEY])[self.WAVE_TYPES.index(wave_type)]
+        return query_envelope(data, lod, start, stop, columns, self.LOD_FACTOR, self.LOD_MIN_LEN)
+
+    def migrate_record(self, key, record):
+        '''
+            json voltage list를 store로 옮기고 record에는 참조만 남긴다.
+        '''
+        if not all(wave_type in record for wave_type in self.WAVE_TYPES):
+            return False
+
+        record[self.REF_KEY] = self.write(
+            key, record[self.WAVE_TYPES[0]], record[self.WAVE_TYPES[1]]
+        )
+        for wave_type in self.WAVE_TYPES:
+            del record[wave_type]
+        return True
+
+
+def opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--master_json', type=str, default='./sample2.json')  # 변환할 master json 파일 경로
+    parser.add_argument('--wave_dir', type=str, default=None)                # binary wave 저장 경로 (default: <master_json>_wave)
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'int16']) # int16 : 정수 ADC count만 가능
+    return parser.parse_args()
+
+def main():
+    args = opt()
+    if args.wave_dir is None:
+        args.wave_dir = WaveformStore.default_dir(args.master_json)
+
+    store = WaveformStore(args.wave_dir, dtype=args.dtype)
+    patient_dict, _ = parse_json(args.master_json)
+
+    cnt = 0
+    for key in tqdm(patient_dict):
+        if store.migrate_record(key, patient_dict[key]):
+            cnt += 1
+
+    write_json(args.master_json, patient_dict)
+    print('{} records moved to {}'.format(cnt, args.wave_dir))
+
+
+if __name__ == '__main__':
+    main()
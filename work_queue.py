@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import sqlite3
+import getpass
+import argparse
+
+from contextlib import contextmanager
+
+from utils import parse_json, write_json, lock_master
+from annotation_journal import AnnotationJournal
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL,      -- 작은 것부터 나눠줌
+    state TEXT NOT NULL,            -- pending / leased / done
+    annotator TEXT,
+    lease_expires REAL,
+    annotation TEXT,                -- commit 된 annotation 상태 (json)
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks (state, priority);
+CREATE INDEX IF NOT EXISTS idx_tasks_annotator ON tasks (annotator, state);
+'''
+
+
+class WorkQueue:
+    '''
+        여러 ECG_GUI가 같은 master를 나눠서 작업하기 위한 lease 기반 작업 대기열
+
+        같은 머신의 sqlite 파일 하나 (default '<master>.queue.db')를 공유하고, 쓰기는 BEGIN IMMEDIATE 파일 lock으로 직렬화한다.
+        - acquire() : 만료된 lease를 대기열로 돌려놓고, 가장 앞의 record를 lease_seconds 동안 빌려준다.
+        - renew() / commit() / release() : 내가 빌린 record만 연장 / 완료 / 반납
+        - export() : commit 된 annotation을 master에 반영 (master 파일은 export 할 때만 쓴다)
+    '''
+    def __init__(self, queue_path, annotator=None, lease_seconds=600):
+        self.queue_path = queue_path
+        self.annotator = annotator
+        if self.annotator is None:
+            self.annotator = getpass.getuser()
+        self.lease_seconds = lease_seconds
+
+        # isolation_level=None : transaction은 _transaction()에서 직접 연다
+        self._conn = sqlite3.connect(queue_path, timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+
+    @staticmethod
+    def default_path(json_path):
+        return os.path.splitext(json_path)[0] + '.queue.db'
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute('BEGIN IMMEDIATE') # 다른 process의 쓰기는 여기서 대기 (timeout 30s)
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def sync(self, patient_dict, keys=None):
+        '''
+            master에 새로 생긴 record를 대기열에 넣는다. (이미 있는 record는 그대로)
+
+            args:
+                keys (list) : 작업 순서 (None이면 master 순서)
+        '''
+        if keys is None:
+            keys = list(patient_dict.keys())
+
+        with self._transaction() as conn:
+            known = {key for (key,) in conn.execute('SELECT key FROM tasks')}
+            rows = []
+            for priority, key in enumerate(keys):
+                if key in known:
+                    continue
+                state = 'done' if patient_dict[key].get('is_annotated') else 'pending'
+                rows.append((key, priority, state))
+            conn.executemany('INSERT INTO tasks (key, priority, state) VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def acquire(self):
+        '''
+            lease 하나를 받아 key를 리턴, 남은 작업이 없으면 None
+            (이전 실행에서 내가 빌린 채로 끝난 record가 있으면 그것부터)
+        '''
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                '''UPDATE tasks SET state = 'pending', annotator = NULL, lease_expires = NULL
+                   WHERE state = 'leased' AND lease_expires < ?''', (now,)
+            )
+            row = conn.execute(
+                '''SELECT key FROM tasks WHERE state = 'leased' AND annotator = ?
+                   ORDER BY priority LIMIT 1''', (self.annotator,)
+            ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    "SELECT key FROM tasks WHERE state = 'pending' ORDER BY priority LIMIT 1"
+                ).fetchone()
+            if row is None:
+                return None
+
+            conn.execute(
+                "UPDATE tasks SET state = 'leased', annotator = ?, lease_expires = ?, updated = ? WHERE key = ?",
+                (self.annotator, now + self.lease_seconds, now, row[0])
+            )
+        return row[0]
+
+    def renew(self, key):
+        now = time.time()
+        with self._transaction() as conn:
+            cur = conn.execute(
+                '''UPDATE tasks SET lease_expires = ?, updated = ?
+                   WHERE key = ? AND state = 'leased' AND annotator = ?''',
+                (now + self.lease_seconds, now, key, self.annotator)
+            )
+        return cur.rowcount == 1
+
+    def commit(self, key, state):
+        '''
+            annotation 상태 (AnnotationJournal.snapshot)를 저장하고 완료 처리
+
+            lease가 만료됐더라도 아직 아무도 가져가지 않았으면 받아준다. (내가 commit 한 record의 재 commit도 허용)
+            return:
+                False이면 다른 annotator가 가져간 record (이 commit은 버려짐)
+        '''
+        now = time.time()
+        with self._transaction() as conn:
+            cur = conn.execute(
+                '''UPDATE tasks SET state = 'done', annotator = ?, lease_expires = NULL, annotation = ?, updated = ?
+                   WHERE key = ? AND (state = 'pending' OR (state IN ('leased', 'done') AND annotator = ?))''',
+                (self.annotator, json.dumps(state, ensure_ascii = False), now, key, self.annotator)
+            )
+        return cur.rowcount == 1
+
+    def release(self, key):
+        with self._transaction() as conn:
+            conn.execute(
+                '''UPDATE tasks SET state = 'pending', annotator = NULL, lease_expires = NULL, updated = ?
+                   WHERE key = ? AND state = 'leased' AND annotator = ?''',
+                (time.time(), key, self.annotator)
+            )
+
+    def status(self):
+        counts = {'pending' : 0, 'leased' : 0, 'done' : 0}
+        for state, cnt in self._conn.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state'):
+            counts[state] = cnt
+        return counts
+
+    def export(self, patient_dict):
+        '''
+            commit 된 annotation 상태를 patient_dict에 반영하고 반영한 record 수를 리턴
+        '''
+        cnt = 0
+        rows = self._conn.execute("SELECT key, annotation FROM tasks WHERE state = 'done' AND annotation IS NOT NULL")
+        for key, annotation in rows:
+            if key not in patient_dict:
+                continue
+            record = patient_dict[key]
+            state = json.loads(annotation)
+            if all(record.get(k) == state[k] for k in AnnotationJournal.STATE_KEYS):
+                continue
+            record.update(state)
+            cnt += 1
+        return cnt
+
+    def close(self):
+        self._conn.close()
+
+
+def opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--master_json', type=str, default='./sample2.json')  # master json 파일 경로
+    parser.add_argument('--queue', type=str, default=None)                   # 작업 대기열 db (default: <master_json>.queue.db)
+    parser.add_argument('--export', action='store_true')                     # commit 된 annotation을 master에 반영
+    return parser.parse_args()
+
+def main():
+    args = opt()
+    if args.queue is None:
+        args.queue = WorkQueue.default_path(args.master_json)
+
+    queue = WorkQueue(args.queue)
+    patient_dict, _ = parse_json(args.master_json, lazy=True)
+    num_added = queue.sync(patient_dict)
+    print('{} records added to {}'.format(num_added, args.queue))
+
+    patient_dict.close()
+
+    if args.export:
+        # 실행 중인 ECG_GUI / report와 겹치지 않도록 lock을 잡고 디스크의 master를 다시 읽어서 반영
+        with lock_master(args.master_json):
+            patient_dict, _ = parse_json(args.master_json, lazy=True)
+            cnt = queue.export(patient_dict)
+            if cnt > 0:
+                write_json(args.master_json, patient_dict)
+            patient_dict.close()
+        print('{} annotations exported to {}'.format(cnt, args.master_json))
+
+    print(queue.status())
+    queue.close()
+
+
+if __name__ == '__main__':
+    main()